@@ -1,12 +1,30 @@
 import streamlit as st
-import psycopg2
+import psycopg
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from dataclasses import dataclass
+from types import MappingProxyType
 from streamlit_option_menu import option_menu
+from sqlalchemy import create_engine
+from openpyxl import Workbook, load_workbook
+import atexit
+import csv
+import gzip
 import hashlib
+import os
+import queue
+import random
+import re
+import threading
 import secrets
+import sys
+import tempfile
+import time
 
 # ============================================================
 # PAGE CONFIGURATION
@@ -73,60 +91,376 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ============================================================
-# DATABASE CONNECTION WITH AUTO-RECOVERY
+# DATABASE CONNECTION POOL (shared by all sessions)
 # ============================================================
-def get_connection():
-    """Get database connection with auto-recovery"""
+def get_db_setting(key, default):
+    """Optional deployment setting from st.secrets"""
     try:
-        if 'db_conn' not in st.session_state or st.session_state.db_conn.closed:
-            conn = psycopg2.connect(
-                st.secrets["NEON_DATABASE_URL"],
-                connect_timeout=10,
-                keepalives=1,
-                keepalives_idle=30,
-                keepalives_interval=10,
-                keepalives_count=5,
-            )
-            st.session_state.db_conn = conn
-        return st.session_state.db_conn
+        return st.secrets.get(key, default)
+    except Exception:
+        return default
+
+def db_flag(key, default=False) -> bool:
+    return str(get_db_setting(key, default)).strip().lower() in ("1", "true", "yes", "on")
+
+def sqlalchemy_url(dsn: str) -> str:
+    """Point a plain postgres:// DSN at the psycopg 3 driver"""
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if dsn.startswith(prefix):
+            return "postgresql+psycopg://" + dsn[len(prefix):]
+    return dsn
+
+def get_pool_limits():
+    min_size = max(int(get_db_setting("DB_POOL_MIN_SIZE", 2)), 1)
+    max_size = max(int(get_db_setting("DB_POOL_MAX_SIZE", 10)), min_size)
+    return min_size, max_size
+
+def build_engine(dsn, warm_up=True):
+    min_size, max_size = get_pool_limits()
+
+    connect_args = {
+        "connect_timeout": 10,
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 5,
+    }
+    if db_flag("DB_PGBOUNCER_MODE"):
+        # PgBouncer transaction pooling can hand us a different backend per
+        # transaction, so server-side prepared statements must stay off
+        connect_args["prepare_threshold"] = None
+
+    engine = create_engine(
+        sqlalchemy_url(dsn),
+        pool_size=min_size,
+        max_overflow=max_size - min_size,
+        pool_timeout=int(get_db_setting("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(get_db_setting("DB_POOL_RECYCLE", 1800)),
+        pool_pre_ping=db_flag("DB_POOL_PRE_PING", True),
+        pool_use_lifo=True,
+        connect_args=connect_args,
+    )
+
+    # Open the minimum number of connections up front so the first sessions
+    # don't each pay the TLS handshake
+    if warm_up:
+        warm = [engine.raw_connection() for _ in range(min_size)]
+        for conn in warm:
+            conn.close()
+    return engine
+
+@st.cache_resource(show_spinner=False)
+def get_engine():
+    """Process-wide pooled engine on the primary; every session checks connections out of it"""
+    return build_engine(st.secrets["NEON_DATABASE_URL"])
+
+@st.cache_resource(show_spinner=False)
+def get_replica_engine():
+    """Pooled engine on the optional read replica (NEON_REPLICA_DATABASE_URL), else None.
+    Not warmed up: an unreachable replica must not fail (and so uncache) the
+    engine; connect errors surface at checkout, where the replica breaker sees them."""
+    dsn = get_db_setting("NEON_REPLICA_DATABASE_URL", "")
+    return build_engine(dsn, warm_up=False) if dsn else None
+
+def note_write():
+    """Pin this session's reads to the primary for a moment after it writes,
+    so it never reads back from a replica that hasn't replayed its change"""
+    try:
+        st.session_state["last_write_at"] = time.monotonic()
+    except Exception:
+        pass  # no session (background thread)
+
+def reads_from_replica() -> bool:
+    if not get_db_setting("NEON_REPLICA_DATABASE_URL", ""):
+        return False
+    try:
+        last_write = st.session_state.get("last_write_at")
+    except Exception:
+        last_write = None
+    return last_write is None or \
+        time.monotonic() - last_write > float(get_db_setting("REPLICA_READ_AFTER_WRITE_SECONDS", 5))
+
+def get_pool_stats() -> dict:
+    pool = get_engine().pool
+    return {
+        "size": pool.size(),
+        "max": get_pool_limits()[1],
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "pgbouncer": db_flag("DB_PGBOUNCER_MODE"),
+        "replica": bool(get_db_setting("NEON_REPLICA_DATABASE_URL", "")),
+        "breaker": get_circuit_breaker("primary").state(),
+        "breaker_trips": get_circuit_breaker("primary").trips,
+    }
+
+# ---- Resilience: circuit breakers, backoff, statement timeouts ----
+class CircuitBreaker:
+    """Opens after `threshold` consecutive connection failures and fails fast for
+    `reset_seconds`; then lets one trial checkout through and closes on its success."""
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+
+    def retry_in(self) -> float:
+        with self._lock:
+            return 0.0 if self.opened_at is None else max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+@st.cache_resource(show_spinner=False)
+def get_circuit_breaker(target: str):
+    """One per database ("primary" / "replica")"""
+    return CircuitBreaker(max(int(get_db_setting("DB_BREAKER_THRESHOLD", 5)), 1),
+                          float(get_db_setting("DB_BREAKER_RESET_SECONDS", 15)))
+
+def backoff_seconds(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number attempt + 1"""
+    base = float(get_db_setting("DB_RETRY_BASE_SECONDS", 0.2))
+    cap = float(get_db_setting("DB_RETRY_MAX_SECONDS", 3.0))
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# statement_timeout per query class in seconds (0 = none); DB_TIMEOUT_<CLASS> overrides
+STATEMENT_TIMEOUTS = {"interactive": 15, "report": 120, "export": 900, "maintenance": 0}
+
+def statement_timeout_ms(query_class: str) -> int:
+    return int(float(get_db_setting(f"DB_TIMEOUT_{query_class.upper()}", STATEMENT_TIMEOUTS[query_class])) * 1000)
+
+def apply_statement_timeout(conn, query_class):
+    """Set the session statement_timeout for this checkout's class. The value is
+    remembered per pooled connection, so steady state costs no round trip. Behind
+    PgBouncer a session setting would stick to a server backend other clients
+    share, so there it is only recorded for set_local_statement_timeout."""
+    ms = statement_timeout_ms(query_class)
+    if db_flag("DB_PGBOUNCER_MODE"):
+        conn.info["local_statement_timeout"] = ms
+        return
+    if conn.info.get("statement_timeout") == ms:
+        return
+    db = conn.driver_connection
+    conn.rollback()  # pre-ping may have opened a transaction; a rollback would undo the SET
+    db.autocommit = True
+    try:
+        db.execute("SELECT set_config('statement_timeout', %s, false)", [f"{ms}ms"])
+    finally:
+        db.autocommit = False
+    conn.info["statement_timeout"] = ms
+
+def set_local_statement_timeout(conn, executor):
+    """PgBouncer mode: apply the checkout's timeout to the open transaction only
+    (set_config(..., true) is SET LOCAL). executor is a cursor or connection
+    already inside that transaction; elsewhere this is a no-op."""
+    ms = conn.info.get("local_statement_timeout")
+    if ms:
+        executor.execute("SELECT set_config('statement_timeout', %s, true)", [f"{ms}ms"])
+
+def cancel_and_discard(conn):
+    """Abandoned mid-statement: stop the server-side work, then drop the connection"""
+    try:
+        db = conn.driver_connection
+        (getattr(db, "cancel_safe", None) or db.cancel)()
+    except Exception:
+        pass
+    conn.invalidate()
+
+def replica_has_replayed(conn, lsn) -> bool:
+    """Whether the replica behind conn has replayed the primary's WAL up to lsn"""
+    try:
+        row = conn.driver_connection.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", [lsn]).fetchone()
+        conn.rollback()
+    except psycopg.Error:
+        conn.invalidate()
+        return False
+    return bool(row and row[0])
+
+def get_connection(read_only=False, query_class="maintenance", replica=True):
+    """Check out a pooled connection; close() hands it back to the pool.
+    read_only connections come from the replica when there is one, its breaker
+    is closed and replica is truthy; a WAL LSN string (replica_for) further
+    requires the replica to have replayed up to it, else the read goes to the
+    primary. While the primary's breaker is open this fails fast.
+    The replica breaker is asked before the replica engine is touched, so an open
+    breaker costs no connect attempt."""
+    target = ("replica" if read_only and replica and reads_from_replica() and get_circuit_breaker("replica").allow()
+              else "primary")
+    breaker = get_circuit_breaker(target)
+    if target == "primary" and not breaker.allow():
+        st.error(f"❌ Database unavailable. Retrying in {breaker.retry_in():.0f}s.")
+        st.stop()
+    try:
+        conn = (get_replica_engine() if target == "replica" else get_engine()).raw_connection()
+        apply_statement_timeout(conn, query_class)
     except Exception as e:
+        breaker.record_failure()
+        if target == "replica":
+            return get_connection(False, query_class)
         st.error(f"❌ Database connection error: {str(e)}")
         st.stop()
-
-def execute_query(query, params=None, fetch=False, fetch_one=False):
-    """Execute query with automatic retry on connection failure"""
-    max_retries = 3
+    breaker.record_success()
+    if target == "replica" and isinstance(replica, str) and not replica_has_replayed(conn, replica):
+        conn.close()
+        return get_connection(read_only, query_class, False)
+    conn.info["target"] = target
+    return conn
+
+def execute_query(query, params=None, fetch=False, fetch_one=False, read_only=False, query_class="interactive",
+                  replica=True):
+    """Execute query, retrying lost connections with jittered backoff.
+
+    read_only statements run in autocommit (no COMMIT round trip), on the
+    replica when one is configured; everything else runs on the primary.
+    query_class picks the statement_timeout (STATEMENT_TIMEOUTS). In PgBouncer
+    mode reads run in a short transaction instead, to scope that timeout.
+    Loaders cached under a data generation pass replica=replica_for(tables):
+    a lagging replica would otherwise store pre-write rows under the post-write key.
+    """
+    max_retries = max(int(get_db_setting("DB_RETRY_ATTEMPTS", 3)), 1)
     for attempt in range(max_retries):
+        conn = get_connection(read_only, query_class, replica)
         try:
-            conn = get_connection()
+            autocommit = read_only and "local_statement_timeout" not in conn.info
+            if read_only:
+                conn.rollback()  # pre-ping may have opened a transaction
+                conn.driver_connection.autocommit = autocommit
             with conn.cursor() as cur:
-                cur.execute(query, params or ())
+                set_local_statement_timeout(conn, cur)
+                cur.execute(query, params or None)
                 if fetch_one:
                     result = cur.fetchone()
-                    conn.commit()
-                    return result
                 elif fetch:
                     result = cur.fetchall()
-                    conn.commit()
-                    return result
                 else:
-                    conn.commit()
-                    return True
-        except psycopg2.OperationalError:
-            if 'db_conn' in st.session_state:
-                try:
-                    st.session_state.db_conn.close()
-                except:
-                    pass
-                del st.session_state.db_conn
+                    result = True
+            if autocommit:
+                conn.driver_connection.autocommit = False
+            elif read_only:
+                conn.rollback()
+            else:
+                conn.commit()
+            return result
+        except psycopg.errors.QueryCanceled:
+            # statement_timeout: the connection is fine and a retry would only time out again
+            conn.rollback()
+            conn.driver_connection.autocommit = False
+            st.error("⏱️ The query took too long and was cancelled. Narrow the filters and try again.")
+            return [] if fetch else False
+        except psycopg.OperationalError:
+            # Drop the broken connection from the pool instead of reusing it
+            conn.invalidate()
+            get_circuit_breaker(conn.info.get("target", "primary")).record_failure()
             if attempt == max_retries - 1:
                 st.error("❌ Database connection lost. Please refresh the page.")
                 return [] if fetch else False
+            time.sleep(backoff_seconds(attempt))
         except Exception as e:
-            conn = get_connection()
-            conn.rollback()
+            try:
+                conn.rollback()
+                conn.driver_connection.autocommit = False
+            except Exception:
+                conn.invalidate()
             st.error(f"❌ Database error: {str(e)}")
             return [] if fetch else False
+        except BaseException:
+            cancel_and_discard(conn)
+            raise
+        finally:
+            conn.close()
+
+@contextmanager
+def autocommit_connection():
+    """Pooled connection in autocommit mode, for statements that can't run in a transaction"""
+    conn = get_connection()
+    try:
+        conn.rollback()  # pre-ping may have opened a transaction
+        conn.driver_connection.autocommit = True
+        yield conn
+    finally:
+        try:
+            conn.driver_connection.autocommit = False
+        except Exception:
+            conn.invalidate()
+        conn.close()
+
+class UnitOfWork:
+    """Statements queued by one save and sent together in one transaction.
+    With psycopg pipeline mode (libpq 14+) the BEGIN, every statement and the
+    COMMIT go out without waiting on each other's results."""
+
+    def __init__(self):
+        self.statements = []
+
+    def add(self, query, params=None):
+        self.statements.append((query, params))
+        return self
+
+    def commit(self) -> bool:
+        """Run everything queued, all or nothing; False (after reporting) on failure"""
+        max_retries = max(int(get_db_setting("DB_RETRY_ATTEMPTS", 3)), 1)
+        for attempt in range(max_retries):
+            conn = get_connection(query_class="interactive")
+            try:
+                conn.rollback()  # pre-ping may have opened a transaction
+                db = conn.driver_connection
+                with db.pipeline() if psycopg.Pipeline.is_supported() else nullcontext():
+                    with db.transaction(), db.cursor() as cur:
+                        set_local_statement_timeout(conn, cur)
+                        for query, params in self.statements:
+                            cur.execute(query, params or None)
+                self.statements = []
+                note_write()
+                return True
+            except psycopg.errors.QueryCanceled:
+                st.error("⏱️ Saving took too long and was cancelled. Nothing was changed.")
+                return False
+            except psycopg.OperationalError:
+                conn.invalidate()
+                get_circuit_breaker("primary").record_failure()
+                if attempt == max_retries - 1:
+                    st.error("❌ Database connection lost. Please refresh the page.")
+                    return False
+                time.sleep(backoff_seconds(attempt))
+            except Exception as e:
+                st.error(f"❌ Database error: {str(e)}")
+                return False
+            except BaseException:
+                cancel_and_discard(conn)
+                raise
+            finally:
+                conn.close()
 
 # ============================================================
 # PASSWORD HASHING
@@ -142,227 +476,1082 @@ def verify_password(password: str, hashed: str, salt: str) -> bool:
     return test_hash == hashed
 
 # ============================================================
-# DATABASE INITIALIZATION (NO DROP / NO DELETE)
+# MONTHLY KPI SUMMARY (rollup kept current by triggers)
 # ============================================================
-def initialize_database():
-    """Initialize database WITHOUT dropping existing data"""
-    try:
-        table_check = execute_query("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'kpi_entries'
-            )
-        """, fetch_one=True)
-
-        tables_exist = table_check[0] if table_check else False
-
-        # Always ensure required tables exist (no drop)
-        # Departments
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS departments (
-                id SERIAL PRIMARY KEY,
-                department_name TEXT UNIQUE NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # Employees
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS employees (
-                id SERIAL PRIMARY KEY,
-                employee_name TEXT UNIQUE NOT NULL,
-                department TEXT NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # Users (include hr role)
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                password_salt TEXT NOT NULL,
-                full_name TEXT NOT NULL,
-                role TEXT NOT NULL CHECK (role IN ('admin', 'manager', 'employee', 'hr')),
-                employee_name TEXT,
-                department TEXT,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP,
-                created_by TEXT
-            )
-        """)
-
-        # KPI Entries
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS kpi_entries (
-                id SERIAL PRIMARY KEY,
-                employee_name TEXT NOT NULL,
-                department TEXT NOT NULL,
-                kpi1 INTEGER NOT NULL,
-                kpi2 INTEGER NOT NULL,
-                kpi3 INTEGER NOT NULL,
-                kpi4 INTEGER NOT NULL,
-                total_score DOUBLE PRECISION NOT NULL,
-                rating TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                entry_month TEXT,
-                created_by TEXT,
-                updated_by TEXT,
-                updated_at TIMESTAMP
-            )
-        """)
-
-        # Audit
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS audit_log (
-                id SERIAL PRIMARY KEY,
-                username TEXT NOT NULL,
-                action TEXT NOT NULL,
-                details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # Settings
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS app_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL
-            )
-        """)
-
-        # KPI master
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS kpi_master (
-                kpi_key TEXT PRIMARY KEY,
-                kpi_label TEXT NOT NULL
-            )
-        """)
+RATING_COLUMNS = {
+    "Excellent": "excellent",
+    "Good": "good",
+    "Average": "average",
+    "Needs Improvement": "needs_improvement",
+}
 
-        # KPI weights
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS kpi_weights (
-                kpi_key TEXT PRIMARY KEY,
-                weight INTEGER NOT NULL
-            )
-        """)
+SUMMARY_COLUMNS = "entry_month, department, employee_name, entry_count, score_sum, score_min, score_max, " + \
+    ", ".join(f"{c}_count, {c}_sum" for c in RATING_COLUMNS.values())
+
+# Aggregates over kpi_entries rows, in SUMMARY_COLUMNS order after the three key columns
+SUMMARY_AGGREGATES = "COUNT(*), SUM(total_score), MIN(total_score), MAX(total_score), " + \
+    ", ".join(f"COUNT(*) FILTER (WHERE rating='{r}'), COALESCE(SUM(total_score) FILTER (WHERE rating='{r}'), 0)"
+              for r in RATING_COLUMNS)
+
+SUMMARY_MERGE = "entry_count = s.entry_count + EXCLUDED.entry_count, " \
+    "score_sum = s.score_sum + EXCLUDED.score_sum, " \
+    "score_min = LEAST(s.score_min, EXCLUDED.score_min), " \
+    "score_max = GREATEST(s.score_max, EXCLUDED.score_max), " + \
+    ", ".join(f"{c}_count = s.{c}_count + EXCLUDED.{c}_count, {c}_sum = s.{c}_sum + EXCLUDED.{c}_sum"
+              for c in RATING_COLUMNS.values())
+
+SUMMARY_DDL = f"""
+CREATE TABLE IF NOT EXISTS kpi_monthly_summary (
+    entry_month TEXT NOT NULL,
+    department TEXT NOT NULL,
+    employee_name TEXT NOT NULL,
+    entry_count INTEGER NOT NULL,
+    score_sum DOUBLE PRECISION NOT NULL,
+    score_min DOUBLE PRECISION,
+    score_max DOUBLE PRECISION,
+    {", ".join(f"{c}_count INTEGER NOT NULL DEFAULT 0, {c}_sum DOUBLE PRECISION NOT NULL DEFAULT 0"
+               for c in RATING_COLUMNS.values())},
+    PRIMARY KEY (entry_month, department, employee_name)
+);
+
+-- Inserts only ever add to a group, so fold the new rows in
+CREATE OR REPLACE FUNCTION kpi_summary_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO kpi_monthly_summary AS s ({SUMMARY_COLUMNS})
+    SELECT to_char(created_at, 'YYYY-MM'), department, employee_name, {SUMMARY_AGGREGATES}
+    FROM new_rows
+    GROUP BY 1, 2, 3
+    ON CONFLICT (entry_month, department, employee_name) DO UPDATE SET {SUMMARY_MERGE};
+    RETURN NULL;
+END $$;
+
+-- Updates and deletes can move min/max, so recompute just the touched groups
+CREATE OR REPLACE FUNCTION kpi_summary_recompute(p_months TEXT[], p_depts TEXT[], p_emps TEXT[])
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+    DELETE FROM kpi_monthly_summary s
+    USING unnest(p_months, p_depts, p_emps) AS k(m, d, e)
+    WHERE s.entry_month = k.m AND s.department = k.d AND s.employee_name = k.e;
+
+    INSERT INTO kpi_monthly_summary ({SUMMARY_COLUMNS})
+    SELECT k.m, k.d, k.e, {SUMMARY_AGGREGATES}
+    FROM (SELECT DISTINCT * FROM unnest(p_months, p_depts, p_emps)) AS k(m, d, e)
+    JOIN kpi_entries ke
+      ON ke.department = k.d AND ke.employee_name = k.e
+     AND ke.created_at >= to_date(k.m, 'YYYY-MM')
+     AND ke.created_at < to_date(k.m, 'YYYY-MM') + INTERVAL '1 month'
+    GROUP BY k.m, k.d, k.e;
+END $$;
+
+CREATE OR REPLACE FUNCTION kpi_summary_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM kpi_summary_recompute(array_agg(to_char(created_at, 'YYYY-MM')), array_agg(department), array_agg(employee_name))
+    FROM old_rows;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION kpi_summary_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM kpi_summary_recompute(array_agg(m), array_agg(d), array_agg(e))
+    FROM (
+        SELECT to_char(created_at, 'YYYY-MM') AS m, department AS d, employee_name AS e FROM old_rows
+        UNION
+        SELECT to_char(created_at, 'YYYY-MM'), department, employee_name FROM new_rows
+    ) touched;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE TRIGGER kpi_summary_insert AFTER INSERT ON kpi_entries
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION kpi_summary_on_insert();
+CREATE OR REPLACE TRIGGER kpi_summary_update AFTER UPDATE ON kpi_entries
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION kpi_summary_on_update();
+CREATE OR REPLACE TRIGGER kpi_summary_delete AFTER DELETE ON kpi_entries
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION kpi_summary_on_delete();
+"""
 
-        # Rating rules
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS rating_rules (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                excellent_min INTEGER NOT NULL,
-                good_min INTEGER NOT NULL,
-                average_min INTEGER NOT NULL
-            )
-        """)
+SUMMARY_REBUILD = f"""
+DELETE FROM kpi_monthly_summary;
+INSERT INTO kpi_monthly_summary ({SUMMARY_COLUMNS})
+SELECT to_char(created_at, 'YYYY-MM'), department, employee_name, {SUMMARY_AGGREGATES}
+FROM kpi_entries
+GROUP BY 1, 2, 3;
+"""
 
-        # Salary base
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS employee_salary (
-                employee_name TEXT PRIMARY KEY,
-                base_salary DOUBLE PRECISION NOT NULL DEFAULT 0,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+def rebuild_monthly_summary():
+    """Recreate kpi_monthly_summary from kpi_entries in one transaction"""
+    return execute_query(SUMMARY_REBUILD)
 
-        # Salary slabs (rating -> %)
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS salary_slabs (
-                rating TEXT PRIMARY KEY,
-                increment_percent DOUBLE PRECISION NOT NULL
-            )
-        """)
+# ============================================================
+# DATABASE INITIALIZATION (NO DROP / NO DELETE)
+# ============================================================
+BOOTSTRAP_SQL = f"""
+SELECT pg_advisory_xact_lock(hashtext('kpi_schema_migrations'));
+
+CREATE TABLE IF NOT EXISTS departments (
+    id SERIAL PRIMARY KEY,
+    department_name TEXT UNIQUE NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS employees (
+    id SERIAL PRIMARY KEY,
+    employee_name TEXT UNIQUE NOT NULL,
+    department TEXT NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Users (include hr role)
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    password_salt TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    role TEXT NOT NULL CHECK (role IN ('admin', 'manager', 'employee', 'hr')),
+    employee_name TEXT,
+    department TEXT,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_login TIMESTAMP,
+    created_by TEXT
+);
+
+CREATE TABLE IF NOT EXISTS kpi_entries (
+    id SERIAL PRIMARY KEY,
+    employee_name TEXT NOT NULL,
+    department TEXT NOT NULL,
+    kpi1 INTEGER NOT NULL,
+    kpi2 INTEGER NOT NULL,
+    kpi3 INTEGER NOT NULL,
+    kpi4 INTEGER NOT NULL,
+    total_score DOUBLE PRECISION NOT NULL,
+    rating TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    entry_month TEXT,
+    created_by TEXT,
+    updated_by TEXT,
+    updated_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS audit_log (
+    id SERIAL PRIMARY KEY,
+    username TEXT NOT NULL,
+    action TEXT NOT NULL,
+    details TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS app_settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS kpi_master (
+    kpi_key TEXT PRIMARY KEY,
+    kpi_label TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS kpi_weights (
+    kpi_key TEXT PRIMARY KEY,
+    weight INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rating_rules (
+    id INTEGER PRIMARY KEY DEFAULT 1,
+    excellent_min INTEGER NOT NULL,
+    good_min INTEGER NOT NULL,
+    average_min INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS employee_salary (
+    employee_name TEXT PRIMARY KEY,
+    base_salary DOUBLE PRECISION NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Salary slabs (rating -> %)
+CREATE TABLE IF NOT EXISTS salary_slabs (
+    rating TEXT PRIMARY KEY,
+    increment_percent DOUBLE PRECISION NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+{SUMMARY_DDL}
+
+-- Defaults (never overwrite existing values)
+INSERT INTO app_settings (key, value)
+VALUES ('allow_import', '1'), ('allow_edit_delete', '1'), ('session_timeout', '30')
+ON CONFLICT (key) DO NOTHING;
+
+INSERT INTO kpi_master (kpi_key, kpi_label)
+VALUES ('kpi1', 'Quality'), ('kpi2', 'Productivity'), ('kpi3', 'Attendance'), ('kpi4', 'Behavior')
+ON CONFLICT (kpi_key) DO NOTHING;
+
+INSERT INTO kpi_weights (kpi_key, weight)
+VALUES ('kpi1', 25), ('kpi2', 25), ('kpi3', 25), ('kpi4', 25)
+ON CONFLICT (kpi_key) DO NOTHING;
+
+INSERT INTO rating_rules (id, excellent_min, good_min, average_min)
+VALUES (1, 80, 60, 40)
+ON CONFLICT (id) DO NOTHING;
+
+INSERT INTO salary_slabs (rating, increment_percent)
+VALUES ('Excellent', 10.0), ('Good', 7.0), ('Average', 3.0), ('Needs Improvement', 0.0)
+ON CONFLICT (rating) DO NOTHING;
+
+-- Sample departments only if empty
+INSERT INTO departments (department_name, is_active, created_at)
+SELECT d, TRUE, CURRENT_TIMESTAMP
+FROM unnest(ARRAY['Fabric', 'Dyeing', 'Quality Control', 'Production', 'Finishing', 'Stitching']) AS d
+WHERE NOT EXISTS (SELECT 1 FROM departments)
+ON CONFLICT (department_name) DO NOTHING;
+
+-- Backfill the monthly rollup the first time it exists
+INSERT INTO kpi_monthly_summary ({SUMMARY_COLUMNS})
+SELECT to_char(created_at, 'YYYY-MM'), department, employee_name, {SUMMARY_AGGREGATES}
+FROM kpi_entries
+WHERE NOT EXISTS (SELECT 1 FROM kpi_monthly_summary)
+GROUP BY 1, 2, 3;
+"""
 
-        # Default settings
-        for key, value in [("allow_import", "1"), ("allow_edit_delete", "1"), ("session_timeout", "30")]:
-            execute_query("""
-                INSERT INTO app_settings(key, value) VALUES (%s, %s)
-                ON CONFLICT (key) DO NOTHING
-            """, [key, value])
-
-        # Default KPI labels
-        for kpi_key, label in [("kpi1", "Quality"), ("kpi2", "Productivity"),
-                               ("kpi3", "Attendance"), ("kpi4", "Behavior")]:
-            execute_query("""
-                INSERT INTO kpi_master(kpi_key, kpi_label) VALUES (%s, %s)
-                ON CONFLICT (kpi_key) DO NOTHING
-            """, [kpi_key, label])
-
-        # Default KPI weights
-        for kpi_key in ["kpi1", "kpi2", "kpi3", "kpi4"]:
-            execute_query("""
-                INSERT INTO kpi_weights(kpi_key, weight) VALUES (%s, %s)
-                ON CONFLICT (kpi_key) DO NOTHING
-            """, [kpi_key, 25])
-
-        # Default rating rules
-        execute_query("""
-            INSERT INTO rating_rules(id, excellent_min, good_min, average_min)
-            VALUES (1, 80, 60, 40)
-            ON CONFLICT (id) DO NOTHING
-        """)
+def read_schema_version() -> int:
+    """The one lookup a process pays when the schema is already current"""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            return int(cur.fetchone()[0])
+    except psycopg.errors.UndefinedTable:
+        return 0
+    finally:
+        conn.rollback()
+        conn.close()
 
-        # Default salary slabs
-        default_slabs = [
-            ("Excellent", 10.0),
-            ("Good", 7.0),
-            ("Average", 3.0),
-            ("Needs Improvement", 0.0),
-        ]
-        for r, pct in default_slabs:
-            execute_query("""
-                INSERT INTO salary_slabs (rating, increment_percent)
-                VALUES (%s, %s)
-                ON CONFLICT (rating) DO NOTHING
-            """, [r, pct])
-
-        # Create admin user if missing
-        admin_exists = execute_query("SELECT id FROM users WHERE username='admin'", fetch=True)
-        if not admin_exists:
+def initialize_database():
+    """Create tables and defaults in one transaction WITHOUT dropping existing data.
+    Only for an unversioned database: the bootstrap recreates objects (the summary
+    functions and triggers) that later migrations replace, so once schema_version
+    has a row (another process may have got there while we waited on the lock)
+    this does nothing."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('kpi_schema_migrations'))")
+            cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if cur.fetchone()[0]:
+                cur.execute("SELECT EXISTS (SELECT 1 FROM schema_version)")
+                if cur.fetchone()[0]:
+                    conn.rollback()
+                    return
+            cur.execute(BOOTSTRAP_SQL)
+
+            # Create admin user if missing
             hashed, salt = hash_password("admin123")
-            execute_query("""
+            cur.execute("""
                 INSERT INTO users (username, password_hash, password_salt, full_name, role, is_active, created_by)
                 VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (username) DO NOTHING
             """, ["admin", hashed, salt, "System Administrator", "admin", True, "system"])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-        # Insert sample departments only if empty
-        dept_count = execute_query("SELECT COUNT(*) FROM departments", fetch_one=True)
-        if dept_count and dept_count[0] == 0:
-            for dept_name in ["Fabric", "Dyeing", "Quality Control", "Production", "Finishing", "Stitching"]:
-                execute_query("""
-                    INSERT INTO departments (department_name, is_active, created_at)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (department_name) DO NOTHING
-                """, [dept_name, True, datetime.now()])
-
-        if tables_exist:
-            st.info("✅ Database exists. Data preserved.")
-        else:
-            st.success("✅ Database initialized with defaults (no data deleted).")
-        return True
+# ============================================================
+# SCHEMA MIGRATIONS (versioned, recorded in schema_version)
+# ============================================================
+# (version, description, statements, concurrent). Concurrent migrations run
+# outside a transaction so CREATE INDEX CONCURRENTLY doesn't block writers.
+# (table, key column, referenced table) for the integer entity keys (migrations 6 and 7)
+ENTITY_KEYS = [
+    ("kpi_entries", "employee_id", "employees"), ("kpi_entries", "department_id", "departments"),
+    ("users", "employee_id", "employees"), ("users", "department_id", "departments"),
+    ("employee_salary", "employee_id", "employees"), ("employees", "department_id", "departments"),
+]
+
+MIGRATIONS = [
+    (1, "kpi_entries indexes for role/sidebar filters and Records sorting", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kpi_entries_created ON kpi_entries (created_at DESC, id DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kpi_entries_dept_created ON kpi_entries (department, created_at DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kpi_entries_emp_created ON kpi_entries (employee_name, created_at DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kpi_entries_rating_created ON kpi_entries (rating, created_at DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kpi_entries_score ON kpi_entries (total_score DESC, id DESC)",
+    ], True),
+    (2, "audit_log indexes for the Audit Log viewer", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_audit_log_timestamp ON audit_log (timestamp DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_audit_log_user_timestamp ON audit_log (username, timestamp DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_audit_log_action_timestamp ON audit_log (action, timestamp DESC)",
+    ], True),
+    (3, "entity_counters maintained by triggers", [
+        "CREATE TABLE IF NOT EXISTS entity_counters (name TEXT PRIMARY KEY, value BIGINT NOT NULL)",
+        # is_active is read through to_jsonb so one function serves tables with and without it
+        """
+        CREATE OR REPLACE FUNCTION entity_counters_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE entity_counters c SET value = c.value + d.delta
+            FROM (
+                SELECT TG_TABLE_NAME::text AS name, COUNT(*) AS delta FROM new_rows
+                UNION ALL
+                SELECT TG_TABLE_NAME || '_active', COUNT(*) FILTER (WHERE (to_jsonb(n) ->> 'is_active')::boolean)
+                FROM new_rows n
+            ) d
+            WHERE c.name = d.name AND d.delta <> 0;
+            RETURN NULL;
+        END $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION entity_counters_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE entity_counters c SET value = c.value - d.delta
+            FROM (
+                SELECT TG_TABLE_NAME::text AS name, COUNT(*) AS delta FROM old_rows
+                UNION ALL
+                SELECT TG_TABLE_NAME || '_active', COUNT(*) FILTER (WHERE (to_jsonb(o) ->> 'is_active')::boolean)
+                FROM old_rows o
+            ) d
+            WHERE c.name = d.name AND d.delta <> 0;
+            RETURN NULL;
+        END $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION entity_counters_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE entity_counters c
+            SET value = c.value
+                + (SELECT COUNT(*) FILTER (WHERE (to_jsonb(n) ->> 'is_active')::boolean) FROM new_rows n)
+                - (SELECT COUNT(*) FILTER (WHERE (to_jsonb(o) ->> 'is_active')::boolean) FROM old_rows o)
+            WHERE c.name = TG_TABLE_NAME || '_active';
+            RETURN NULL;
+        END $$
+        """,
+        *[sql for t in ("users", "employees", "departments", "kpi_entries") for sql in (
+            f"CREATE OR REPLACE TRIGGER {t}_count_insert AFTER INSERT ON {t} "
+            f"REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION entity_counters_on_insert()",
+            f"CREATE OR REPLACE TRIGGER {t}_count_delete AFTER DELETE ON {t} "
+            f"REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION entity_counters_on_delete()",
+        )],
+        *[f"CREATE OR REPLACE TRIGGER {t}_count_update AFTER UPDATE ON {t} "
+          f"REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION entity_counters_on_update()"
+          for t in ("users", "employees", "departments")],
+        # Seed from real counts while writers wait, so no change slips between count and trigger
+        "LOCK TABLE users, employees, departments, kpi_entries IN SHARE MODE",
+        """
+        INSERT INTO entity_counters (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'users_active', COUNT(*) FILTER (WHERE is_active) FROM users
+        UNION ALL SELECT 'employees', COUNT(*) FROM employees
+        UNION ALL SELECT 'employees_active', COUNT(*) FILTER (WHERE is_active) FROM employees
+        UNION ALL SELECT 'departments', COUNT(*) FROM departments
+        UNION ALL SELECT 'departments_active', COUNT(*) FILTER (WHERE is_active) FROM departments
+        UNION ALL SELECT 'kpi_entries', COUNT(*) FROM kpi_entries
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+        """,
+    ], False),
+    (4, "audit_log range-partitioned by month", [
+        "LOCK TABLE audit_log IN ACCESS EXCLUSIVE MODE",
+        "ALTER TABLE audit_log RENAME TO audit_log_unpartitioned",
+        "ALTER SEQUENCE IF EXISTS audit_log_id_seq RENAME TO audit_log_unpartitioned_id_seq",
+        "DROP INDEX IF EXISTS idx_audit_log_timestamp, idx_audit_log_user_timestamp, idx_audit_log_action_timestamp",
+        """
+        CREATE TABLE audit_log (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+            username TEXT NOT NULL,
+            action TEXT NOT NULL,
+            details TEXT,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+        """,
+        "CREATE TABLE audit_log_default PARTITION OF audit_log DEFAULT",
+        # Month partitions are built beside the default one and attached, so rows
+        # that landed in the default partition move into their month first
+        """
+        CREATE OR REPLACE FUNCTION audit_log_ensure_partition(p_month TIMESTAMP) RETURNS TEXT
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            lo TIMESTAMP := date_trunc('month', p_month);
+            hi TIMESTAMP := lo + INTERVAL '1 month';
+            part TEXT := 'audit_log_p' || to_char(lo, 'YYYYMM');
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('audit_log_partitions'));
+            IF to_regclass(part) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I (LIKE audit_log INCLUDING DEFAULTS)', part);
+                EXECUTE format('WITH moved AS (DELETE FROM audit_log_default WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                               'INSERT INTO %I SELECT * FROM moved', lo, hi, part);
+                EXECUTE format('ALTER TABLE audit_log ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', part, lo, hi);
+            END IF;
+            RETURN part;
+        END $$
+        """,
+        """
+        SELECT audit_log_ensure_partition(m)
+        FROM (
+            SELECT DISTINCT date_trunc('month', timestamp) AS m FROM audit_log_unpartitioned WHERE timestamp IS NOT NULL
+            UNION SELECT date_trunc('month', CURRENT_TIMESTAMP)::timestamp
+        ) months
+        """,
+        """
+        INSERT INTO audit_log (id, username, action, details, timestamp)
+        SELECT id, username, action, details, COALESCE(timestamp, TIMESTAMP '1970-01-01')
+        FROM audit_log_unpartitioned
+        """,
+        "SELECT setval(pg_get_serial_sequence('audit_log', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM audit_log",
+        "DROP TABLE audit_log_unpartitioned",
+        "CREATE INDEX idx_audit_log_timestamp ON audit_log (timestamp DESC, id DESC)",
+        "CREATE INDEX idx_audit_log_user_timestamp ON audit_log (username, timestamp DESC, id DESC)",
+        "CREATE INDEX idx_audit_log_action_timestamp ON audit_log (action, timestamp DESC, id DESC)",
+    ], False),
+    (5, "audit_log full-text search column and GIN index", [
+        """
+        ALTER TABLE audit_log ADD COLUMN IF NOT EXISTS search_tsv TSVECTOR GENERATED ALWAYS AS (
+            to_tsvector('simple', username || ' ' || action || ' ' || COALESCE(details, ''))
+        ) STORED
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_search ON audit_log USING GIN (search_tsv)",
+        # New month partitions must carry the generated column too
+        """
+        CREATE OR REPLACE FUNCTION audit_log_ensure_partition(p_month TIMESTAMP) RETURNS TEXT
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            lo TIMESTAMP := date_trunc('month', p_month);
+            hi TIMESTAMP := lo + INTERVAL '1 month';
+            part TEXT := 'audit_log_p' || to_char(lo, 'YYYYMM');
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('audit_log_partitions'));
+            IF to_regclass(part) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I (LIKE audit_log INCLUDING DEFAULTS INCLUDING GENERATED)', part);
+                EXECUTE format('WITH moved AS (DELETE FROM audit_log_default WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                               'INSERT INTO %I (id, username, action, details, timestamp) '
+                               'SELECT id, username, action, details, timestamp FROM moved', lo, hi, part);
+                EXECUTE format('ALTER TABLE audit_log ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', part, lo, hi);
+            END IF;
+            RETURN part;
+        END $$
+        """,
+    ], False),
+    # Nullable columns and NOT VALID keys are catalog-only changes; migration 7 fills and validates them
+    (6, "employee_id / department_id keys with fill and rename triggers", [
+        "ALTER TABLE kpi_entries ADD COLUMN IF NOT EXISTS employee_id INTEGER, ADD COLUMN IF NOT EXISTS department_id INTEGER",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS employee_id INTEGER, ADD COLUMN IF NOT EXISTS department_id INTEGER",
+        "ALTER TABLE employee_salary ADD COLUMN IF NOT EXISTS employee_id INTEGER",
+        "ALTER TABLE employees ADD COLUMN IF NOT EXISTS department_id INTEGER",
+        *[f"ALTER TABLE {t} ADD CONSTRAINT {t}_{c}_fkey FOREIGN KEY ({c}) REFERENCES {ref} (id) ON DELETE SET NULL NOT VALID"
+          for t, c, ref in ENTITY_KEYS],
+        # Writers keep sending names; the keys follow them (COPY imports included)
+        """
+        CREATE OR REPLACE FUNCTION fill_entity_keys() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            -- Nested so a table without the column never evaluates NEW.<column>
+            IF TG_TABLE_NAME <> 'employees' THEN
+                IF NEW.employee_id IS NULL OR (TG_OP = 'UPDATE' AND NEW.employee_name IS DISTINCT FROM OLD.employee_name
+                                               AND NEW.employee_id IS NOT DISTINCT FROM OLD.employee_id) THEN
+                    NEW.employee_id := (SELECT id FROM employees WHERE employee_name = NEW.employee_name);
+                END IF;
+            END IF;
+            IF TG_TABLE_NAME <> 'employee_salary' THEN
+                IF NEW.department_id IS NULL OR (TG_OP = 'UPDATE' AND NEW.department IS DISTINCT FROM OLD.department
+                                                 AND NEW.department_id IS NOT DISTINCT FROM OLD.department_id) THEN
+                    NEW.department_id := (SELECT id FROM departments WHERE department_name = NEW.department);
+                END IF;
+            END IF;
+            RETURN NEW;
+        END $$
+        """,
+        "CREATE OR REPLACE TRIGGER kpi_entries_fill_keys BEFORE INSERT OR UPDATE OF employee_name, department "
+        "ON kpi_entries FOR EACH ROW EXECUTE FUNCTION fill_entity_keys()",
+        "CREATE OR REPLACE TRIGGER users_fill_keys BEFORE INSERT OR UPDATE OF employee_name, department "
+        "ON users FOR EACH ROW EXECUTE FUNCTION fill_entity_keys()",
+        "CREATE OR REPLACE TRIGGER employee_salary_fill_keys BEFORE INSERT OR UPDATE OF employee_name "
+        "ON employee_salary FOR EACH ROW EXECUTE FUNCTION fill_entity_keys()",
+        "CREATE OR REPLACE TRIGGER employees_fill_keys BEFORE INSERT OR UPDATE OF department "
+        "ON employees FOR EACH ROW EXECUTE FUNCTION fill_entity_keys()",
+        # A rename carries the key's rows along instead of orphaning them
+        """
+        CREATE OR REPLACE FUNCTION employees_propagate_name() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            DELETE FROM employee_salary WHERE employee_name = NEW.employee_name AND employee_id IS NULL;
+            UPDATE employee_salary SET employee_name = NEW.employee_name WHERE employee_id = NEW.id;
+            UPDATE users SET employee_name = NEW.employee_name WHERE employee_id = NEW.id;
+            UPDATE kpi_entries SET employee_name = NEW.employee_name WHERE employee_id = NEW.id;
+            RETURN NULL;
+        END $$
+        """,
+        "CREATE OR REPLACE TRIGGER employees_propagate_name AFTER UPDATE OF employee_name ON employees FOR EACH ROW "
+        "WHEN (OLD.employee_name IS DISTINCT FROM NEW.employee_name) EXECUTE FUNCTION employees_propagate_name()",
+        """
+        CREATE OR REPLACE FUNCTION departments_propagate_name() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE employees SET department = NEW.department_name WHERE department_id = NEW.id;
+            UPDATE users SET department = NEW.department_name WHERE department_id = NEW.id;
+            UPDATE kpi_entries SET department = NEW.department_name WHERE department_id = NEW.id;
+            RETURN NULL;
+        END $$
+        """,
+        "CREATE OR REPLACE TRIGGER departments_propagate_name AFTER UPDATE OF department_name ON departments FOR EACH ROW "
+        "WHEN (OLD.department_name IS DISTINCT FROM NEW.department_name) EXECUTE FUNCTION departments_propagate_name()",
+        # Only rows whose summarised columns changed count, so the key backfill touches no group
+        """
+        CREATE OR REPLACE FUNCTION kpi_summary_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM kpi_summary_recompute(array_agg(touched.m), array_agg(touched.d), array_agg(touched.e))
+            FROM old_rows o
+            JOIN new_rows n USING (id)
+            CROSS JOIN LATERAL (VALUES (to_char(o.created_at, 'YYYY-MM'), o.department, o.employee_name),
+                                       (to_char(n.created_at, 'YYYY-MM'), n.department, n.employee_name)) AS touched(m, d, e)
+            WHERE (o.created_at, o.department, o.employee_name, o.total_score, o.rating)
+                  IS DISTINCT FROM (n.created_at, n.department, n.employee_name, n.total_score, n.rating);
+            RETURN NULL;
+        END $$
+        """,
+    ], False),
+    # Autocommit: the procedure commits every batch, so no long transaction holds row locks
+    (7, "backfill employee_id / department_id, index and validate", [
+        """
+        CREATE OR REPLACE PROCEDURE backfill_entity_keys(batch_rows INTEGER) LANGUAGE plpgsql AS $$
+        DECLARE
+            lo INTEGER := 0;
+            hi INTEGER;
+        BEGIN
+            UPDATE employees e SET department_id = d.id
+            FROM departments d WHERE e.department_id IS NULL AND d.department_name = e.department;
+            UPDATE employee_salary s SET employee_id = e.id
+            FROM employees e WHERE s.employee_id IS NULL AND e.employee_name = s.employee_name;
+            UPDATE users u
+            SET employee_id = (SELECT id FROM employees WHERE employee_name = u.employee_name),
+                department_id = (SELECT id FROM departments WHERE department_name = u.department)
+            WHERE u.employee_id IS NULL OR u.department_id IS NULL;
+            COMMIT;
+
+            SELECT COALESCE(MAX(id), 0) INTO hi FROM kpi_entries;
+            WHILE lo < hi LOOP
+                UPDATE kpi_entries k
+                SET employee_id = COALESCE(k.employee_id, (SELECT id FROM employees WHERE employee_name = k.employee_name)),
+                    department_id = COALESCE(k.department_id, (SELECT id FROM departments WHERE department_name = k.department))
+                WHERE k.id > lo AND k.id <= lo + batch_rows AND (k.employee_id IS NULL OR k.department_id IS NULL);
+                lo := lo + batch_rows;
+                COMMIT;
+            END LOOP;
+        END $$
+        """,
+        "CALL backfill_entity_keys(5000)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kpi_entries_emp_id_created ON kpi_entries (employee_id, created_at DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kpi_entries_dept_id_created ON kpi_entries (department_id, created_at DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_employees_department_id ON employees (department_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_employee_salary_employee_id ON employee_salary (employee_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_employee_id ON users (employee_id)",
+        *[f"ALTER TABLE {t} VALIDATE CONSTRAINT {t}_{c}_fkey" for t, c, ref in ENTITY_KEYS],
+    ], True),
+    (8, "audit_facets distinct usernames / actions for the Audit Log filters", [
+        """
+        CREATE TABLE IF NOT EXISTS audit_facets (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (kind, value)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION audit_facets_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO audit_facets (kind, value)
+            SELECT 'username', username FROM new_rows
+            UNION SELECT 'action', action FROM new_rows
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END $$
+        """,
+        "CREATE OR REPLACE TRIGGER audit_facets_insert AFTER INSERT ON audit_log "
+        "REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION audit_facets_on_insert()",
+        # Seed while writers wait, so no value slips between the scan and the trigger
+        "LOCK TABLE audit_log IN SHARE MODE",
+        """
+        INSERT INTO audit_facets (kind, value)
+        SELECT 'username', username FROM audit_log
+        UNION SELECT 'action', action FROM audit_log
+        ON CONFLICT DO NOTHING
+        """,
+    ], False),
+    # One counter row per name made every concurrent writer of a table queue on
+    # it; each statement now adds its delta to one of 16 shard rows instead
+    (9, "entity_counters sharded so concurrent writers don't share a row", [
+        "ALTER TABLE entity_counters ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0",
+        "ALTER TABLE entity_counters DROP CONSTRAINT entity_counters_pkey, ADD PRIMARY KEY (name, shard)",
+        """
+        CREATE OR REPLACE FUNCTION entity_counters_add(p_name TEXT, p_delta BIGINT) RETURNS void LANGUAGE sql AS $$
+            INSERT INTO entity_counters AS c (name, shard, value)
+            SELECT p_name, floor(random() * 16)::smallint, p_delta
+            WHERE p_delta <> 0
+            ON CONFLICT (name, shard) DO UPDATE SET value = c.value + EXCLUDED.value
+        $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION entity_counters_on_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM entity_counters_add(TG_TABLE_NAME, COUNT(*)),
+                    entity_counters_add(TG_TABLE_NAME || '_active',
+                                        COUNT(*) FILTER (WHERE (to_jsonb(n) ->> 'is_active')::boolean))
+            FROM new_rows n;
+            RETURN NULL;
+        END $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION entity_counters_on_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM entity_counters_add(TG_TABLE_NAME, -COUNT(*)),
+                    entity_counters_add(TG_TABLE_NAME || '_active',
+                                        -COUNT(*) FILTER (WHERE (to_jsonb(o) ->> 'is_active')::boolean))
+            FROM old_rows o;
+            RETURN NULL;
+        END $$
+        """,
+        """
+        CREATE OR REPLACE FUNCTION entity_counters_on_update() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM entity_counters_add(TG_TABLE_NAME || '_active',
+                (SELECT COUNT(*) FILTER (WHERE (to_jsonb(n) ->> 'is_active')::boolean) FROM new_rows n)
+                - (SELECT COUNT(*) FILTER (WHERE (to_jsonb(o) ->> 'is_active')::boolean) FROM old_rows o));
+            RETURN NULL;
+        END $$
+        """,
+    ], False),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def apply_migration(conn, version, description, statements, concurrent):
+    db = conn.driver_connection
+    if concurrent:
+        for sql in statements:
+            # A failed concurrent build leaves an INVALID index that IF NOT EXISTS would skip
+            index_name = re.search(r"IF NOT EXISTS (\w+)", sql)
+            if index_name:
+                invalid = db.execute("""
+                    SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = %s AND NOT i.indisvalid
+                """, [index_name.group(1)]).fetchone()
+                if invalid:
+                    db.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name.group(1)}")
+            db.execute(sql)
+        db.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", [version, description])
+    else:
+        with db.transaction():
+            for sql in statements:
+                db.execute(sql)
+            db.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", [version, description])
+
+def run_migrations():
+    """Apply pending migrations in order"""
+    with autocommit_connection() as conn:
+        db = conn.driver_connection
+        # One process migrates; others wait here and then find nothing left to do
+        db.execute("SELECT pg_advisory_lock(hashtext('kpi_schema_migrations'))")
+        try:
+            current = db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            for version, description, statements, concurrent in MIGRATIONS:
+                if version > current:
+                    apply_migration(conn, version, description, statements, concurrent)
+        finally:
+            db.execute("SELECT pg_advisory_unlock(hashtext('kpi_schema_migrations'))")
+
+@st.cache_resource(show_spinner=False)
+def ensure_schema():
+    """Once per process: a current schema costs one version lookup, an empty one
+    bootstraps, and a stale one runs only its pending migrations"""
+    version = read_schema_version()
+    if version >= SCHEMA_VERSION:
+        return SCHEMA_VERSION
+    if version == 0:
+        initialize_database()
+    run_migrations()
+    return SCHEMA_VERSION
+
+with st.spinner("🔄 Checking database..."):
+    try:
+        ensure_schema()
     except Exception as e:
         st.error(f"❌ Database initialization error: {str(e)}")
+        st.stop()
+
+# ============================================================
+# AUDIT LOG (write-behind: queued here, batch-inserted by a background thread)
+# ============================================================
+AUDIT_COLUMNS = ("username", "action", "details", "timestamp")
+
+class AuditSink:
+    """Bounded in-process queue drained by one daemon thread that COPYs batches
+    into audit_log. When the queue is full, log_action waits up to
+    block_seconds and then drops the event (counted in `dropped`)."""
+
+    def __init__(self, engine, capacity, batch_rows, flush_seconds, block_seconds):
+        self.engine = engine
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.block_seconds = block_seconds
+        self.queue = queue.Queue(maxsize=capacity)
+        self.stats = {"written": 0, "dropped": 0, "failed": 0, "batches": 0, "last_error": None}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="audit-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, event):
+        try:
+            self.queue.put(event, timeout=self.block_seconds)
+        except queue.Full:
+            self._count("dropped")
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _take_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_seconds)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_rows:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        for attempt in range(3):
+            conn = None
+            try:
+                conn = self.engine.raw_connection()
+                with conn.cursor() as cur:
+                    with cur.copy(f"COPY audit_log ({', '.join(AUDIT_COLUMNS)}) FROM STDIN") as copy:
+                        for event in batch:
+                            copy.write_row(event)
+                conn.commit()
+                conn.close()
+                self._count("written", len(batch))
+                self._count("batches")
+                return
+            except Exception as e:
+                if conn is not None:
+                    conn.invalidate()
+                with self._stats_lock:
+                    self.stats["last_error"] = f"{datetime.now():%H:%M:%S} {e}"
+                time.sleep(0.5 * (attempt + 1))
+        self._count("failed", len(batch))
+
+    def _run(self):
+        # Keep draining after close() until the queue is empty
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+
+    def close(self, timeout=10.0):
+        """Flush what is queued; registered with atexit so shutdown doesn't lose events"""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            return {**self.stats, "depth": self.queue.qsize(), "capacity": self.queue.maxsize}
+
+    def generation(self) -> int:
+        """Batches committed so far; changes whenever new entries become readable"""
+        with self._stats_lock:
+            return self.stats["batches"]
+
+@st.cache_resource(show_spinner=False)
+def get_audit_sink():
+    return AuditSink(
+        get_engine(),
+        capacity=max(int(get_db_setting("AUDIT_QUEUE_SIZE", 10000)), 1),
+        batch_rows=max(int(get_db_setting("AUDIT_BATCH_ROWS", 500)), 1),
+        flush_seconds=float(get_db_setting("AUDIT_FLUSH_SECONDS", 0.5)),
+        block_seconds=float(get_db_setting("AUDIT_BLOCK_SECONDS", 0.2)),
+    )
+
+def log_action(username: str, action: str, details: str = ""):
+    get_audit_sink().submit((username, action, details, datetime.now()))
+
+AUDIT_SEARCH_PROBE_ROWS = 2000
+
+@st.cache_data(show_spinner=False, ttl=120, max_entries=1)
+def load_audit_facets() -> dict:
+    """Usernames and actions ever logged, from the trigger-maintained audit_facets.
+    Audit rows arrive from every process's sink, so this goes by TTL alone."""
+    rows = execute_query("SELECT kind, value FROM audit_facets ORDER BY kind, value",
+                         fetch=True, read_only=True) or []
+    facets = {"username": [], "action": []}
+    for kind, value in rows:
+        facets.setdefault(kind, []).append(value)
+    return facets
+
+def audit_search_is_sparse(where_sql, params) -> bool:
+    """tsvector statistics can't tell a rare token from a common one, so count
+    matches through the GIN index up to a cap. Few matches are cheaper to
+    collect and sort; many are found fastest by walking the timestamp index."""
+    row = execute_query(f"SELECT COUNT(*) FROM (SELECT 1 FROM audit_log{where_sql} LIMIT %s) m",
+                        list(params) + [AUDIT_SEARCH_PROBE_ROWS], fetch_one=True, read_only=True)
+    return bool(row) and row[0] < AUDIT_SEARCH_PROBE_ROWS
+
+# ---- Monthly partitions, retention and archival ----
+AUDIT_PARTITIONS_AHEAD = 2
+AUDIT_PARTITION_RE = re.compile(r"^audit_log_p(\d{6})$")
+
+def add_months(month: datetime, n: int) -> datetime:
+    idx = month.year * 12 + month.month - 1 + n
+    return month.replace(year=idx // 12, month=idx % 12 + 1, day=1)
+
+def list_audit_partitions():
+    """[(partition name, month start, estimated rows)] for the monthly partitions, oldest first"""
+    rows = execute_query("""
+        SELECT c.relname, c.reltuples::BIGINT
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'audit_log'::regclass
+    """, fetch=True) or []
+    parts = []
+    for name, est in rows:
+        match = AUDIT_PARTITION_RE.match(name)
+        if match:
+            parts.append((name, datetime.strptime(match.group(1), "%Y%m"), max(int(est), 0)))
+    return sorted(parts, key=lambda p: p[1])
+
+def ensure_audit_partitions(month: datetime, ahead=AUDIT_PARTITIONS_AHEAD):
+    """Current month plus `ahead` future months, so inserts never fall back to the default partition"""
+    conn = get_connection()
+    try:
+        pg = conn.driver_connection
+        with pg.transaction():
+            return [pg.execute("SELECT audit_log_ensure_partition(%s)", [add_months(month, n)]).fetchone()[0]
+                    for n in range(ahead + 1)]
+    finally:
+        conn.close()
+
+def archive_audit_partitions(retention_months: int, now=None):
+    """Detach partitions older than the retention window, gzip them as CSV, then drop them.
+    The archive file is complete before the DROP commits; any failure leaves the partition attached."""
+    if retention_months <= 0:
+        return []
+    cutoff = add_months((now or datetime.now()).replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+                        -(retention_months - 1))
+    archive_dir = get_db_setting("AUDIT_ARCHIVE_DIR", "audit_archive")
+    os.makedirs(archive_dir, exist_ok=True)
+
+    archived = []
+    for name, month, _ in list_audit_partitions():
+        if month >= cutoff:
+            break
+        path = os.path.join(archive_dir, f"{name}.csv.gz")
+        conn = get_connection()
+        try:
+            pg = conn.driver_connection
+            with pg.transaction():
+                pg.execute(f"ALTER TABLE audit_log DETACH PARTITION {name}")
+                with pg.cursor() as cur, gzip.open(f"{path}.part", "wb") as fh:
+                    with cur.copy(f"COPY {name} (id, username, action, details, timestamp) TO STDOUT WITH (FORMAT csv, HEADER)") as copy:
+                        for data in copy:
+                            fh.write(data)
+                os.replace(f"{path}.part", path)
+                pg.execute(f"DROP TABLE {name}")
+            archived.append(path)
+        finally:
+            conn.close()
+    return archived
+
+@st.cache_resource(show_spinner=False)
+def maintain_audit_partitions(month_key: str):
+    """Once per process per month: create upcoming partitions and apply retention.
+    Errors propagate, so a failed run isn't cached and the next rerun retries."""
+    created = ensure_audit_partitions(datetime.strptime(month_key, "%Y-%m"))
+    row = execute_query("SELECT value FROM app_settings WHERE key='audit_retention_months'", fetch_one=True)
+    return {"created": created, "archived": archive_audit_partitions(int(row[0]) if row else 0)}
+
+try:
+    maintain_audit_partitions(datetime.now().strftime("%Y-%m"))
+    audit_maintenance_error = None
+except Exception as e:
+    audit_maintenance_error = str(e)
+
+# ============================================================
+# DATA GENERATIONS (write-driven cache invalidation)
+# ============================================================
+@st.cache_resource(show_spinner=False)
+def get_generation_registry():
+    """Process-wide per-table write counters; caches include them in their keys.
+    With a replica configured, "lsn" also holds the primary's WAL position after
+    each table's latest write (None when it couldn't be read)."""
+    return {"lock": threading.Lock(), "tables": {}, "lsn": {}}
+
+def lsn_value(lsn: str) -> int:
+    """'16/B374D848' -> comparable integer"""
+    hi, lo = lsn.split("/")
+    return (int(hi, 16) << 32) | int(lo, 16)
+
+def bump_generation(*tables):
+    """Call after a successful write so every cache keyed on these tables reloads"""
+    lsn = False
+    if get_db_setting("NEON_REPLICA_DATABASE_URL", ""):
+        row = execute_query("SELECT pg_current_wal_lsn()::text", fetch_one=True, read_only=True, replica=False)
+        lsn = row[0] if row else None
+    registry = get_generation_registry()
+    with registry["lock"]:
+        for t in tables:
+            registry["tables"][t] = registry["tables"].get(t, 0) + 1
+            if lsn is not False:
+                registry["lsn"][t] = lsn
+    note_write()
+
+def data_generation(*tables) -> tuple:
+    registry = get_generation_registry()
+    return tuple(registry["tables"].get(t, 0) for t in tables)
+
+def replica_for(*tables):
+    """execute_query's replica argument for a load cached under data_generation(*tables):
+    the WAL LSN of the tables' latest write, which the replica must have replayed
+    before it can serve the load; True when none is recorded; False (primary)
+    when a write's LSN is unknown"""
+    registry = get_generation_registry()
+    with registry["lock"]:
+        lsns = [registry["lsn"][t] for t in tables if t in registry["lsn"]]
+    if not lsns:
+        return True
+    if None in lsns:
         return False
+    return max(lsns, key=lsn_value)
+
+# ============================================================
+# ENTITY COUNTERS (sidebar Data Status, Dashboard, System Info)
+# ============================================================
+COUNTED_TABLES = ("users", "employees", "departments", "kpi_entries")
 
-if "db_initialized" not in st.session_state:
-    with st.spinner("🔄 Checking database..."):
-        if initialize_database():
-            st.session_state.db_initialized = True
+@st.cache_data(show_spinner=False, ttl=300, max_entries=8)
+def load_entity_counts(generation) -> dict:
+    """Counter rows are maintained by triggers, so this sums a few shard rows regardless of table size"""
+    rows = execute_query("SELECT name, SUM(value) FROM entity_counters GROUP BY name",
+                         fetch=True, read_only=True, replica=replica_for(*COUNTED_TABLES)) or []
+    return {name: int(value) for name, value in rows}
+
+def get_entity_counts() -> dict:
+    return load_entity_counts(data_generation(*COUNTED_TABLES))
 
 # ============================================================
-# AUDIT LOG
+# RESULT CACHE (filtered KPI query rows shared by all sessions)
 # ============================================================
-def log_action(username: str, action: str, details: str = ""):
-    execute_query(
-        "INSERT INTO audit_log (username, action, details, timestamp) VALUES (%s, %s, %s, %s)",
-        [username, action, details, datetime.now()]
-    )
+class ResultCache:
+    """LRU of loaded results bounded by their total memory (size_of). Keys end
+    with the data generation they were loaded at; storing a newer generation
+    discards the older entries. Cached values are shared, so callers must not
+    mutate them."""
+
+    def __init__(self, max_bytes, size_of):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries = OrderedDict()  # key -> (value, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def _drop(self, key):
+        _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = int(self.size_of(value))
+        with self._lock:
+            for old in [k for k in self._entries if k[-1] != key[-1]]:
+                self._drop(old)
+            if key in self._entries:
+                self._drop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Empty results aren't stored: execute_query returns [] / False for a
+        failed read too, and that must not stick until the next write"""
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value:
+                self.put(key, value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+def rows_size(rows) -> int:
+    """Approximate memory of fetched rows (a row list or a single row tuple)"""
+    if isinstance(rows, tuple):
+        rows = [rows]
+    return sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in rows)
+
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    return ResultCache(max(int(get_db_setting("RESULT_CACHE_MB", 64)), 1) * 1024 * 1024, size_of=rows_size)
+
+def cached_kpi_rows(key, loader):
+    """Rows of a kpi_entries read, shared until the next kpi_entries write.
+    key must identify the query and every filter it applies; the loader must
+    pass replica=replica_for("kpi_entries")."""
+    return get_result_cache().get_or_load(key + (data_generation("kpi_entries"),), loader)
+
+# ============================================================
+# PAGE DATASETS (what each menu page reads, fetched on first use)
+# ============================================================
+PAGE_DATASETS = {
+    "Dashboard": {"kpi_aggregates", "kpi_monthly"},
+    "Entry": {"kpi_labels"},
+    "Import": {"kpi_labels"},
+    "Records": {"kpi_labels"},
+    "My Records": {"kpi_labels"},
+    "Reports": {"kpi_monthly"},
+    "Settings": {"kpi_labels"},
+}
+
+class PageData:
+    """Datasets the current page declared in PAGE_DATASETS. Each is loaded on
+    first access and reused for the rest of the rerun; pages that declare
+    nothing (Employees, Departments, Users, Audit Log) cost no KPI query."""
+
+    def __init__(self, page, loaders):
+        self.page = page
+        self.declared = PAGE_DATASETS.get(page, set())
+        self._loaders = loaders
+        self._values = {}
+
+    def __getitem__(self, name):
+        if name not in self.declared:
+            raise KeyError(f"{self.page} does not declare dataset {name!r}")
+        if name not in self._values:
+            self._values[name] = self._loaders[name]()
+        return self._values[name]
 
 # ============================================================
 # HELPER FUNCTIONS
@@ -371,38 +1560,108 @@ def get_setting(key, default=""):
     result = execute_query("SELECT value FROM app_settings WHERE key=%s", [key], fetch_one=True)
     return result[0] if result else default
 
-def set_setting(key, value):
-    execute_query("""
+def set_setting(key, value, uow=None):
+    (uow.add if uow else execute_query)("""
         INSERT INTO app_settings(key, value) VALUES (%s, %s)
         ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value
     """, [key, value])
 
+# ---- Scoring policy ----
+RATING_BINS = ("Needs Improvement", "Average", "Good", "Excellent")
+
+@dataclass(frozen=True)
+class ScoringPolicy:
+    """Immutable snapshot of KPI labels, weights, rating rules and salary slabs"""
+    labels: tuple
+    weights: tuple
+    rules: tuple
+    slabs: MappingProxyType
+
+    def score(self, k1, k2, k3, k4):
+        w1, w2, w3, w4 = self.weights
+        return round((k1*w1 + k2*w2 + k3*w3 + k4*w4) / 100.0, 2)
+
+    def rating(self, score: float):
+        ex, gd, av = self.rules
+        if score >= ex: return "Excellent"
+        if score >= gd: return "Good"
+        if score >= av: return "Average"
+        return "Needs Improvement"
+
+    def increment_percent(self, avg_score: float) -> float:
+        return float(self.slabs.get(self.rating(avg_score), 0.0))
+
+    def rating_series(self, scores: pd.Series) -> pd.Series:
+        """Vectorized rating(): bin scores on the thresholds (ascending once
+        load_scoring_policy has normalized them). NaN compares false against
+        every threshold in rating(), so it lands in the lowest bin here too."""
+        ex, gd, av = self.rules
+        values = scores.to_numpy(dtype=float)
+        bins = np.searchsorted(np.array([av, gd, ex], dtype=float), values, side="right")
+        bins[np.isnan(values)] = 0
+        return pd.Series(np.array(RATING_BINS, dtype=object)[bins], index=scores.index)
+
+    def increment_series(self, ratings: pd.Series) -> pd.Series:
+        return ratings.map(dict(self.slabs)).fillna(0.0).astype(float)
+
+@st.cache_resource(show_spinner=False)
+def load_scoring_policy() -> ScoringPolicy:
+    """Loaded once per process and shared by all sessions until invalidated.
+    The bootstrap seeds all four tables, so an empty read means the query
+    failed; that raises so the defaults are never cached."""
+    label_rows = execute_query("SELECT kpi_key, kpi_label FROM kpi_master ORDER BY kpi_key", fetch=True)
+    weight_rows = execute_query("SELECT kpi_key, weight FROM kpi_weights ORDER BY kpi_key", fetch=True)
+    rules = execute_query("SELECT excellent_min, good_min, average_min FROM rating_rules WHERE id=1", fetch_one=True)
+    slab_rows = execute_query("SELECT rating, increment_percent FROM salary_slabs", fetch=True)
+    if not (label_rows and weight_rows and rules and slab_rows):
+        raise RuntimeError("Scoring settings could not be read")
+
+    labels = {k: v for k, v in label_rows}
+    weights = {k: int(w) for k, w in weight_rows}
+    slabs = {r: float(p) for r, p in slab_rows}
+    # Settings only saves ex >= gd >= av, but the row can be edited directly.
+    # Capping each threshold at the ones above it keeps rating() unchanged
+    # (a band above a higher threshold was unreachable) and sorts them.
+    ex = int(rules[0])
+    gd = min(int(rules[1]), ex)
+    av = min(int(rules[2]), gd)
+
+    return ScoringPolicy(
+        labels=(labels.get("kpi1", "KPI 1"), labels.get("kpi2", "KPI 2"),
+                labels.get("kpi3", "KPI 3"), labels.get("kpi4", "KPI 4")),
+        weights=(weights.get("kpi1", 25), weights.get("kpi2", 25),
+                 weights.get("kpi3", 25), weights.get("kpi4", 25)),
+        rules=(ex, gd, av),
+        slabs=MappingProxyType(slabs),
+    )
+
+def get_scoring_policy() -> ScoringPolicy:
+    """The cached policy; while it can't be loaded, uncached defaults so pages
+    still render and the next call tries the database again"""
+    try:
+        return load_scoring_policy()
+    except RuntimeError:
+        return ScoringPolicy(labels=("KPI 1", "KPI 2", "KPI 3", "KPI 4"), weights=(25, 25, 25, 25),
+                             rules=(80, 60, 40), slabs=MappingProxyType({}))
+
+def invalidate_scoring_policy():
+    """Call after saving labels, weights, rating rules or salary slabs"""
+    load_scoring_policy.clear()
+
 def get_kpi_labels():
-    rows = execute_query("SELECT kpi_key, kpi_label FROM kpi_master ORDER BY kpi_key", fetch=True) or []
-    labels = {k: v for k, v in rows}
-    return (labels.get("kpi1", "KPI 1"), labels.get("kpi2", "KPI 2"),
-            labels.get("kpi3", "KPI 3"), labels.get("kpi4", "KPI 4"))
+    return get_scoring_policy().labels
 
 def get_kpi_weights():
-    rows = execute_query("SELECT kpi_key, weight FROM kpi_weights ORDER BY kpi_key", fetch=True) or []
-    weights = {k: int(w) for k, w in rows}
-    return (weights.get("kpi1", 25), weights.get("kpi2", 25),
-            weights.get("kpi3", 25), weights.get("kpi4", 25))
+    return get_scoring_policy().weights
 
 def get_rating_rules():
-    result = execute_query("SELECT excellent_min, good_min, average_min FROM rating_rules WHERE id=1", fetch_one=True)
-    return (int(result[0]), int(result[1]), int(result[2])) if result else (80, 60, 40)
+    return get_scoring_policy().rules
 
 def calc_weighted_score(k1, k2, k3, k4):
-    w1, w2, w3, w4 = get_kpi_weights()
-    return round((k1*w1 + k2*w2 + k3*w3 + k4*w4) / 100.0, 2)
+    return get_scoring_policy().score(k1, k2, k3, k4)
 
 def calc_rating(score: float):
-    ex, gd, av = get_rating_rules()
-    if score >= ex: return "Excellent"
-    if score >= gd: return "Good"
-    if score >= av: return "Average"
-    return "Needs Improvement"
+    return get_scoring_policy().rating(score)
 
 def get_active_employees():
     return execute_query(
@@ -410,37 +1669,71 @@ def get_active_employees():
         fetch=True
     ) or []
 
-def get_all_employees():
-    return execute_query(
-        "SELECT id, employee_name, department, is_active, created_at FROM employees ORDER BY employee_name",
-        fetch=True
-    ) or []
-
 def get_active_departments():
     rows = execute_query("SELECT department_name FROM departments WHERE is_active=TRUE ORDER BY department_name", fetch=True) or []
     return [r[0] for r in rows]
 
-def get_all_departments():
-    return execute_query("SELECT id, department_name, is_active, created_at FROM departments ORDER BY department_name", fetch=True) or []
+@st.cache_data(show_spinner=False, ttl=300, max_entries=4)
+def load_filter_dimensions(generation) -> tuple:
+    """(department names, employee names, {department: employee names}) for the
+    sidebar filters, read from the dimension tables"""
+    replica = replica_for("employees", "departments")
+    depts = execute_query("SELECT department_name FROM departments ORDER BY department_name",
+                          fetch=True, read_only=True, replica=replica) or []
+    emps = execute_query("SELECT employee_name, department FROM employees ORDER BY employee_name",
+                         fetch=True, read_only=True, replica=replica) or []
+    by_dept = {}
+    for name, dept in emps:
+        by_dept.setdefault(dept, []).append(name)
+    return [d[0] for d in depts], [e[0] for e in emps], by_dept
+
+def get_filter_dimensions() -> tuple:
+    return load_filter_dimensions(data_generation("employees", "departments"))
+
+def get_employee_roster(department=None):
+    """Employees with their base salary in one joined query (Employees > Manage)"""
+    query = """
+        SELECT e.id, e.employee_name, e.department, e.is_active, e.created_at,
+               COALESCE(s.base_salary, 0)
+        FROM employees e
+        LEFT JOIN employee_salary s ON s.employee_id = e.id
+    """
+    params = []
+    if department:
+        query += " WHERE e.department=%s"
+        params.append(department)
+    return execute_query(query + " ORDER BY e.employee_name", params, fetch=True, read_only=True) or []
+
+def get_department_roster():
+    """Departments with their employee count in one grouped query (Departments > Manage)"""
+    return execute_query("""
+        SELECT d.id, d.department_name, d.is_active, d.created_at, COUNT(e.id)
+        FROM departments d
+        LEFT JOIN employees e ON e.department_id = d.id
+        GROUP BY d.id
+        ORDER BY d.department_name
+    """, fetch=True, read_only=True) or []
 
 # ---- Salary helpers ----
 def get_salary_slabs():
-    rows = execute_query("SELECT rating, increment_percent FROM salary_slabs", fetch=True) or []
-    return {r: float(p) for r, p in rows}
+    return dict(get_scoring_policy().slabs)
 
-def set_salary_slab(rating: str, pct: float):
-    execute_query("""
+def set_salary_slab(rating: str, pct: float, uow=None):
+    (uow.add if uow else execute_query)("""
         INSERT INTO salary_slabs (rating, increment_percent)
         VALUES (%s, %s)
         ON CONFLICT (rating) DO UPDATE SET increment_percent=EXCLUDED.increment_percent
     """, [rating, float(pct)])
 
-def get_employee_base_salary(emp_name: str) -> float:
-    row = execute_query("SELECT base_salary FROM employee_salary WHERE employee_name=%s", [emp_name], fetch_one=True)
-    return float(row[0]) if row else 0.0
+def get_all_base_salaries() -> dict:
+    rows = execute_query("""
+        SELECT e.employee_name, s.base_salary
+        FROM employee_salary s JOIN employees e ON e.id = s.employee_id
+    """, fetch=True, read_only=True) or []
+    return {e: float(sal) for e, sal in rows}
 
-def set_employee_base_salary(emp_name: str, salary: float):
-    execute_query("""
+def set_employee_base_salary(emp_name: str, salary: float, uow=None):
+    (uow.add if uow else execute_query)("""
         INSERT INTO employee_salary (employee_name, base_salary, updated_at)
         VALUES (%s, %s, %s)
         ON CONFLICT (employee_name) DO UPDATE
@@ -448,9 +1741,560 @@ def set_employee_base_salary(emp_name: str, salary: float):
     """, [emp_name, float(salary), datetime.now()])
 
 def calc_increment_percent(avg_score: float) -> float:
-    rating = calc_rating(avg_score)
-    slabs = get_salary_slabs()
-    return float(slabs.get(rating, 0.0))
+    return get_scoring_policy().increment_percent(avg_score)
+
+# ============================================================
+# KPI QUERY HELPERS
+# ============================================================
+MONTH_RANGE_SQL = " AND created_at >= to_date(%s, 'YYYY-MM') AND created_at < to_date(%s, 'YYYY-MM') + INTERVAL '1 month'"
+
+KpiFilters = namedtuple("KpiFilters", ["role", "user_department", "user_employee_name",
+                                       "dept_filter", "emp_filter", "rating_filter", "date_range"])
+
+def kpi_filter_sql(f: KpiFilters, include_rating=True, include_dates=True, keyed=True):
+    """WHERE clause + params for kpi_entries under the role and sidebar filters.
+
+    Employee and department filters compare the integer keys, resolved from
+    the name in the same statement; keyed=False compares names instead, for
+    kpi_monthly_summary which is keyed on them.
+    """
+    sql = " WHERE 1=1"
+    params = []
+    emp_sql, dept_sql = "employee_name=%s", "department=%s"
+    if keyed:
+        emp_sql = "employee_id=(SELECT id FROM employees WHERE employee_name=%s)"
+        dept_sql = "department_id=(SELECT id FROM departments WHERE department_name=%s)"
+
+    if f.role == "employee":
+        sql += f" AND {emp_sql}"
+        params.append(f.user_employee_name)
+    elif f.role == "manager":
+        sql += f" AND {dept_sql}"
+        params.append(f.user_department)
+
+    if f.dept_filter != "All" and f.role == "admin":
+        sql += f" AND {dept_sql}"
+        params.append(f.dept_filter)
+    if f.emp_filter != "All" and f.role != "employee":
+        sql += f" AND {emp_sql}"
+        params.append(f.emp_filter)
+    if include_rating and f.rating_filter != "All":
+        sql += " AND rating=%s"
+        params.append(f.rating_filter)
+    if include_dates and len(f.date_range) == 2:
+        sql += " AND DATE(created_at) BETWEEN %s AND %s"
+        params += [str(f.date_range[0]), str(f.date_range[1])]
+
+    return sql, params
+
+def get_monthly_rollup(f: KpiFilters, group_by, m_from=None, m_to=None) -> pd.DataFrame:
+    """Average score per group (any of entry_month/department/employee_name) for a month range.
+
+    Served from kpi_monthly_summary; only a day-level date range has to
+    fall back to aggregating kpi_entries directly.
+    """
+    if len(f.date_range) == 2:
+        where_sql, params = kpi_filter_sql(f)
+        source = "kpi_entries"
+        month_expr = "to_char(created_at, 'YYYY-MM')"
+        cnt_expr, sum_expr = "COUNT(*)", "SUM(total_score)"
+    else:
+        where_sql, params = kpi_filter_sql(f, include_rating=False, include_dates=False, keyed=False)
+        source = "kpi_monthly_summary"
+        month_expr = "entry_month"
+        col = RATING_COLUMNS.get(f.rating_filter)
+        cnt_expr, sum_expr = (f"SUM({col}_count)", f"SUM({col}_sum)") if col else ("SUM(entry_count)", "SUM(score_sum)")
+
+    if m_from and m_to:
+        if source == "kpi_entries":
+            where_sql += MONTH_RANGE_SQL
+        else:
+            where_sql += " AND entry_month BETWEEN %s AND %s"
+        params += [m_from, m_to]
+
+    keys = [month_expr if g == "entry_month" else g for g in group_by]
+    rows = cached_kpi_rows(("rollup", f, tuple(group_by), m_from, m_to), lambda: execute_query(f"""
+        SELECT {", ".join(keys)}, {cnt_expr} AS n, {sum_expr} AS total
+        FROM {source}{where_sql}
+        GROUP BY {", ".join(keys)}
+        HAVING {cnt_expr} > 0
+    """, params, fetch=True, read_only=True, query_class="report", replica=replica_for("kpi_entries"))) or []
+
+    names = {"entry_month": "Month", "department": "Department", "employee_name": "Employee"}
+    out = pd.DataFrame(rows, columns=[names[g] for g in group_by] + ["Count", "Total"])
+    out["Score"] = out["Total"].astype(float) / out["Count"].astype(float)
+    return out.drop(columns=["Total"])
+
+def get_detailed_report(f: KpiFilters, m_from, m_to) -> pd.DataFrame:
+    where_sql, params = kpi_filter_sql(f)
+    rows = execute_query(f"""
+        SELECT employee_name, department, total_score, rating
+        FROM kpi_entries{where_sql}{MONTH_RANGE_SQL}
+        ORDER BY created_at DESC
+    """, params + [m_from, m_to], fetch=True, read_only=True, query_class="report") or []
+    return compact_kpi_frame(pd.DataFrame(rows, columns=["Employee", "Department", "Score", "Rating"]))
+
+def get_dashboard_aggregates(f: KpiFilters) -> dict:
+    """Dashboard totals and per-group averages in one GROUPING SETS round trip"""
+    where_sql, params = kpi_filter_sql(f)
+    rows = cached_kpi_rows(("aggregates", f), lambda: execute_query(f"""
+        SELECT
+            CASE WHEN GROUPING(department) = 0 THEN 'department'
+                 WHEN GROUPING(employee_name) = 0 THEN 'employee'
+                 ELSE 'total' END AS grp,
+            department,
+            employee_name,
+            COUNT(*),
+            AVG(total_score),
+            MAX(total_score),
+            COUNT(*) FILTER (WHERE rating='Excellent'),
+            COUNT(*) FILTER (WHERE rating='Good'),
+            COUNT(*) FILTER (WHERE rating='Average'),
+            COUNT(*) FILTER (WHERE rating='Needs Improvement')
+        FROM kpi_entries{where_sql}
+        GROUP BY GROUPING SETS ((), (department), (employee_name))
+    """, params, fetch=True, read_only=True, query_class="report", replica=replica_for("kpi_entries"))) or []
+
+    agg = {
+        "count": 0, "avg": 0.0, "max": 0.0,
+        "ratings": {r: 0 for r in ("Excellent", "Good", "Average", "Needs Improvement")},
+        "departments": [], "employees": [],
+    }
+    for grp, dept, emp, cnt, avg, mx, n_ex, n_gd, n_av, n_ni in rows:
+        if grp == "total":
+            agg.update(count=cnt, avg=float(avg or 0), max=float(mx or 0))
+            agg["ratings"] = {"Excellent": n_ex, "Good": n_gd, "Average": n_av, "Needs Improvement": n_ni}
+        elif grp == "department":
+            agg["departments"].append((dept, float(avg)))
+        else:
+            agg["employees"].append((emp, float(avg)))
+
+    agg["departments"] = pd.DataFrame(agg["departments"], columns=["Department", "Score"])
+    agg["employees"] = pd.DataFrame(agg["employees"], columns=["Employee", "Score"])
+    return agg
+
+# ---- Records grid (keyset pagination) ----
+KPI_FRAME_COLUMNS = ["ID", "Employee", "Department", "KPI1", "KPI2", "KPI3", "KPI4",
+                     "Score", "Rating", "Created At", "Created By"]
+# Repeated strings as categoricals, KPIs (1-100) as uint8 and scores as float32:
+# a fraction of the object/int64/float64 frame pandas infers from raw rows.
+# Per-entry frames only: aggregated scores stay float64, since float32 moves
+# averages such as 59.995 across a two-decimal rating threshold.
+KPI_FRAME_DTYPES = {"ID": "int32", "Employee": "category", "Department": "category",
+                    "KPI1": "uint8", "KPI2": "uint8", "KPI3": "uint8", "KPI4": "uint8",
+                    "Score": "float32", "Rating": "category", "Created At": "datetime64[ns]",
+                    "Created By": "category"}
+
+def compact_kpi_frame(frame: pd.DataFrame) -> pd.DataFrame:
+    """Cast whichever KPI_FRAME_COLUMNS the frame has to KPI_FRAME_DTYPES"""
+    return frame.astype({c: t for c, t in KPI_FRAME_DTYPES.items() if c in frame.columns}, copy=False)
+
+def kpi_frame_from_rows(rows) -> pd.DataFrame:
+    return compact_kpi_frame(pd.DataFrame(rows, columns=KPI_FRAME_COLUMNS))
+
+RECORD_COLUMNS = """id, employee_name, department, kpi1, kpi2, kpi3, kpi4, total_score, rating,
+       created_at, COALESCE(created_by, 'system') as created_by"""
+
+# label -> (sort column, direction, row position of the sort column)
+RECORD_SORTS = {
+    "🕒 Newest first": ("created_at", "DESC", 9),
+    "🕒 Oldest first": ("created_at", "ASC", 9),
+    "⭐ Score high → low": ("total_score", "DESC", 7),
+    "⭐ Score low → high": ("total_score", "ASC", 7),
+    "👤 Employee A → Z": ("employee_name", "ASC", 1),
+}
+
+def record_sort_key(row, sort_label):
+    """Keyset cursor (sort value, id) for a fetched row"""
+    return (row[RECORD_SORTS[sort_label][2]], row[0])
+
+def fetch_records_page(where_sql, params, sort_label, cursor, page_size):
+    """One page after `cursor`, seeking on (sort column, id) instead of OFFSET"""
+    col, direction, _ = RECORD_SORTS[sort_label]
+    params = list(params)
+    if cursor is not None:
+        op = "<" if direction == "DESC" else ">"
+        where_sql += f" AND ({col}, id) {op} (%s, %s)"
+        params += [cursor[0], cursor[1]]
+
+    params += [page_size + 1]
+    rows = cached_kpi_rows(("records", where_sql, tuple(params), sort_label), lambda: execute_query(f"""
+        SELECT {RECORD_COLUMNS}
+        FROM kpi_entries{where_sql}
+        ORDER BY {col} {direction}, id {direction}
+        LIMIT %s
+    """, params, fetch=True, read_only=True, replica=replica_for("kpi_entries"))) or []
+    return rows[:page_size], len(rows) > page_size
+
+def count_kpi_entries(where_sql, params) -> int:
+    row = cached_kpi_rows(("count", where_sql, tuple(params)), lambda: execute_query(
+        f"SELECT COUNT(*) FROM kpi_entries{where_sql}", params, fetch_one=True, read_only=True,
+        replica=replica_for("kpi_entries")))
+    return int(row[0]) if row else 0
+
+def search_kpi_entries(where_sql, params, text, limit=20):
+    """Edit/Delete picker: match on record ID or employee name"""
+    params = list(params)
+    text = (text or "").strip()
+    if text.isdigit():
+        where_sql += " AND id=%s"
+        params.append(int(text))
+    elif text:
+        where_sql += " AND employee_name ILIKE %s"
+        params.append(f"%{text}%")
+
+    return execute_query(f"""
+        SELECT id, employee_name, created_at, total_score
+        FROM kpi_entries{where_sql}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """, params + [limit], fetch=True, read_only=True) or []
+
+def get_kpi_entry(where_sql, params, rec_id):
+    row = execute_query(f"SELECT {RECORD_COLUMNS} FROM kpi_entries{where_sql} AND id=%s",
+                        list(params) + [rec_id], fetch_one=True, read_only=True)
+    if not row:
+        return None
+    return dict(zip(["ID", "Employee", "Department", "KPI1", "KPI2", "KPI3", "KPI4",
+                     "Score", "Rating", "Created At", "Created By"], row))
+
+# ============================================================
+# BULK KPI IMPORT (CSV / Excel -> COPY -> set-based insert)
+# ============================================================
+IMPORT_CHUNK_ROWS = 5000
+
+IMPORT_ALIASES = {
+    "employee": "employee_name", "employee name": "employee_name", "name": "employee_name",
+    "dept": "department",
+    "date": "created_at", "created at": "created_at", "entry date": "created_at",
+}
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_employee_lookup(generation) -> dict:
+    rows = execute_query("SELECT employee_name, department, is_active FROM employees", fetch=True) or []
+    return {name: (dept, bool(active)) for name, dept, active in rows}
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_department_names(generation) -> frozenset:
+    rows = execute_query("SELECT department_name FROM departments", fetch=True) or []
+    return frozenset(r[0] for r in rows)
+
+def iter_import_chunks(uploaded):
+    """Yield (first file row number, DataFrame) without materialising the whole sheet"""
+    uploaded.seek(0)
+    if uploaded.name.lower().endswith(".xlsx"):
+        wb = load_workbook(uploaded, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(h) if h is not None else "" for h in next(rows, [])]
+        buf, start = [], 2
+        for values in rows:
+            buf.append(values)
+            if len(buf) == IMPORT_CHUNK_ROWS:
+                yield start, pd.DataFrame(buf, columns=header)
+                start += len(buf)
+                buf = []
+        if buf:
+            yield start, pd.DataFrame(buf, columns=header)
+        wb.close()
+    else:
+        start = 2
+        for chunk in pd.read_csv(uploaded, chunksize=IMPORT_CHUNK_ROWS, dtype=str, skipinitialspace=True):
+            yield start, chunk
+            start += len(chunk)
+
+def normalize_import_columns(chunk, labels):
+    aliases = dict(IMPORT_ALIASES)
+    for i, lbl in enumerate(labels, 1):
+        aliases[lbl.strip().lower()] = f"kpi{i}"
+        aliases[f"kpi {i}"] = f"kpi{i}"
+    cols = [str(c).strip().lower() for c in chunk.columns]
+    return chunk.set_axis([aliases.get(c, c) for c in cols], axis=1)
+
+def validate_import_chunk(chunk, first_row, policy, employees, departments, role, user_dept):
+    """Vectorized checks + scoring; returns (valid rows ready for COPY, error rows)"""
+    chunk = normalize_import_columns(chunk, policy.labels)
+    missing = [c for c in ["employee_name", "kpi1", "kpi2", "kpi3", "kpi4"] if c not in chunk.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    chunk = chunk.reset_index(drop=True)
+    row_no = pd.Series(range(first_row, first_row + len(chunk)))
+    emp = chunk["employee_name"].astype("string").str.strip()
+    master_dept = emp.map({n: d for n, (d, _) in employees.items()})
+    active = emp.map({n: a for n, (_, a) in employees.items()})
+
+    problems = {
+        "Unknown employee": master_dept.isna(),
+        "Inactive employee": active.eq(False),
+    }
+    if "department" in chunk.columns:
+        given = chunk["department"].astype("string").str.strip()
+        has_dept = given.notna() & given.ne("")
+        known = given.isin(departments)
+        problems["Unknown department"] = has_dept & ~known
+        problems["Department does not match employee master"] = has_dept & known & master_dept.notna() & given.ne(master_dept)
+    if role == "manager":
+        problems["Employee not in your department"] = master_dept.notna() & master_dept.ne(user_dept)
+
+    kpis = {}
+    for k in ["kpi1", "kpi2", "kpi3", "kpi4"]:
+        v = pd.to_numeric(chunk[k], errors="coerce")
+        problems[f"{k} must be a whole number 1-100"] = v.isna() | (v < 1) | (v > 100) | (v % 1 != 0)
+        kpis[k] = v
+
+    now = datetime.now()
+    if "created_at" in chunk.columns:
+        raw = chunk["created_at"]
+        created = pd.to_datetime(raw, errors="coerce", format="mixed")
+        problems["Invalid date"] = raw.notna() & raw.astype("string").str.strip().ne("") & created.isna()
+        created = created.fillna(now)
+    else:
+        created = pd.Series(now, index=chunk.index)
+
+    flags = pd.DataFrame({msg: mask.fillna(False).astype(bool) for msg, mask in problems.items()})
+    bad = flags.any(axis=1)
+
+    errors = pd.DataFrame({
+        "Row": row_no[bad],
+        "Employee": chunk.loc[bad, "employee_name"],
+        "Error": flags[bad].apply(lambda r: "; ".join(r.index[r]), axis=1) if bad.any() else pd.Series(dtype=str),
+    })
+
+    ok = ~bad
+    w1, w2, w3, w4 = policy.weights
+    valid = pd.DataFrame({
+        "employee_name": emp[ok],
+        "department": master_dept[ok],
+        "kpi1": kpis["kpi1"][ok].astype(int),
+        "kpi2": kpis["kpi2"][ok].astype(int),
+        "kpi3": kpis["kpi3"][ok].astype(int),
+        "kpi4": kpis["kpi4"][ok].astype(int),
+    })
+    valid["total_score"] = ((valid["kpi1"] * w1 + valid["kpi2"] * w2 + valid["kpi3"] * w3 + valid["kpi4"] * w4) / 100.0).round(2)
+    valid["rating"] = policy.rating_series(valid["total_score"])
+    valid["created_at"] = pd.to_datetime(created[ok])
+    return valid, errors
+
+IMPORT_COLUMNS = ["employee_name", "department", "kpi1", "kpi2", "kpi3", "kpi4", "total_score", "rating", "created_at"]
+
+def run_kpi_import(uploaded, role, user_dept, created_by, dry_run=True) -> dict:
+    """Validate the file chunk by chunk; unless dry_run, COPY valid rows to staging and insert them in one statement"""
+    policy = get_scoring_policy()
+    employees = load_employee_lookup(data_generation("employees"))
+    departments = load_department_names(data_generation("departments"))
+
+    result = {"rows": 0, "valid": 0, "inserted": 0, "preview": [], "errors": []}
+    conn = None if dry_run else get_connection()
+    try:
+        cur = None
+        if conn is not None:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TEMP TABLE kpi_import_staging (
+                    employee_name TEXT, department TEXT,
+                    kpi1 INTEGER, kpi2 INTEGER, kpi3 INTEGER, kpi4 INTEGER,
+                    total_score DOUBLE PRECISION, rating TEXT, created_at TIMESTAMP
+                ) ON COMMIT DROP
+            """)
+
+        for first_row, chunk in iter_import_chunks(uploaded):
+            valid, errors = validate_import_chunk(chunk, first_row, policy, employees, departments, role, user_dept)
+            result["rows"] += len(chunk)
+            result["valid"] += len(valid)
+            if len(errors):
+                result["errors"].append(errors)
+            if len(result["preview"]) < 100:
+                result["preview"].extend(valid.head(100 - len(result["preview"])).to_dict("records"))
+
+            if cur is not None and len(valid):
+                columns = [valid[c].tolist() for c in IMPORT_COLUMNS[:-1]]
+                columns.append(valid["created_at"].to_numpy(dtype="datetime64[us]").tolist())
+                with cur.copy(f"COPY kpi_import_staging ({', '.join(IMPORT_COLUMNS)}) FROM STDIN") as copy:
+                    for row in zip(*columns):
+                        copy.write_row(row)
+
+        if cur is not None:
+            cur.execute(f"""
+                INSERT INTO kpi_entries ({', '.join(IMPORT_COLUMNS)}, entry_month, created_by)
+                SELECT {', '.join(IMPORT_COLUMNS)}, to_char(created_at, 'YYYY-MM'), %s
+                FROM kpi_import_staging
+            """, [created_by])
+            result["inserted"] = cur.rowcount
+            cur.close()
+            conn.commit()
+    except Exception:
+        if conn is not None:
+            conn.rollback()
+        raise
+    finally:
+        if conn is not None:
+            conn.close()
+
+    result["errors"] = pd.concat(result["errors"], ignore_index=True) if result["errors"] else \
+        pd.DataFrame(columns=["Row", "Employee", "Error"])
+    result["preview"] = pd.DataFrame(result["preview"], columns=IMPORT_COLUMNS)
+    return result
+
+# ============================================================
+# STREAMING EXPORTS (server-side cursor -> CSV / Excel / Parquet)
+# ============================================================
+EXPORT_BATCH_ROWS = 5000
+EXCEL_SHEET_ROWS = 1_000_000  # Excel stops at 1,048,576 rows per sheet
+
+# label -> (file extension, mime type)
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+def iter_query_batches(query, params=None, batch_rows=EXPORT_BATCH_ROWS):
+    """Stream a result set from a named (server-side) cursor, batch_rows at a time.
+    A consumer that stops early closes the cursor between batches, which ends the
+    query on the server instead of draining it; the connection stays pooled."""
+    conn = get_connection(read_only=True, query_class="export")
+    try:
+        pg = conn.driver_connection
+        with pg.transaction():
+            set_local_statement_timeout(conn, pg)
+            with pg.cursor(name=f"export_{secrets.token_hex(6)}") as cur:
+                cur.itersize = batch_rows
+                cur.execute(query, params or None)
+                while True:
+                    rows = cur.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    yield rows
+    except psycopg.OperationalError:
+        conn.invalidate()  # the cursor and transaction couldn't be closed cleanly
+        raise
+    finally:
+        conn.close()
+
+def iter_frame_batches(frame, batch_rows=EXPORT_BATCH_ROWS):
+    """Feed an already-built report DataFrame through the same writers"""
+    for start in range(0, len(frame), batch_rows):
+        yield list(frame.iloc[start:start + batch_rows].itertuples(index=False, name=None))
+
+def write_csv_export(path, columns, batches):
+    with open(path, "w", newline="", encoding="utf-8-sig") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows(rows)
+
+def write_xlsx_export(path, columns, batches):
+    """Write-only workbook: rows go straight to disk, a new sheet every EXCEL_SHEET_ROWS"""
+    wb = Workbook(write_only=True)
+    ws, sheet_rows = None, EXCEL_SHEET_ROWS
+    for rows in batches:
+        for row in rows:
+            if sheet_rows >= EXCEL_SHEET_ROWS:
+                ws = wb.create_sheet(f"Sheet{len(wb.worksheets) + 1}")
+                ws.append(columns)
+                sheet_rows = 0
+            ws.append([v.replace(tzinfo=None) if isinstance(v, datetime) else v for v in row])
+            sheet_rows += 1
+    if ws is None:
+        wb.create_sheet("Sheet1").append(columns)
+    wb.save(path)
+
+def write_parquet_export(path, columns, batches):
+    """One row group per batch; the schema is fixed by the first batch"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer, schema = None, None
+    try:
+        for rows in batches:
+            data = {c: [row[i] for row in rows] for i, c in enumerate(columns)}
+            if schema is None:
+                inferred = pa.Table.from_pydict(data).schema
+                # All-NULL columns in the first batch would otherwise pin the type to null
+                schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                                    for f in inferred])
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+        if writer is None:
+            pq.write_table(pa.table({c: pa.array([], pa.string()) for c in columns}), path)
+    finally:
+        if writer is not None:
+            writer.close()
+
+EXPORT_WRITERS = {"csv": write_csv_export, "xlsx": write_xlsx_export, "parquet": write_parquet_export}
+
+def purge_stale_exports():
+    """Delete export files older than EXPORT_MAX_AGE_HOURS (default 6). Sessions
+    that are closed or expire never reach export_panel's cleanup, so their files
+    would otherwise stay in the temp directory."""
+    cutoff = time.time() - float(get_db_setting("EXPORT_MAX_AGE_HOURS", 6)) * 3600
+    tmp = tempfile.gettempdir()
+    for name in os.listdir(tmp):
+        if not name.startswith("kpi_export_"):
+            continue
+        path = os.path.join(tmp, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass  # removed by another session meanwhile
+
+def build_export(fmt, columns, batches):
+    """Write the batches to a temp file in `fmt`; returns (path, row count)"""
+    ext, _ = EXPORT_FORMATS[fmt]
+    row_count = 0
+    purge_stale_exports()
+
+    def counted():
+        nonlocal row_count
+        for rows in batches:
+            row_count += len(rows)
+            yield rows
+
+    fd, path = tempfile.mkstemp(prefix="kpi_export_", suffix=f".{ext}")
+    os.close(fd)
+    try:
+        EXPORT_WRITERS[ext](path, columns, counted())
+    except Exception:
+        os.remove(path)
+        raise
+    return path, row_count
+
+def export_panel(key, file_stem, columns, make_batches, signature):
+    """Format picker + 'Prepare' button; the file is only built on request and
+    discarded once the filters (signature) change"""
+    state_key = f"{key}_export"
+    prepared = st.session_state.get(state_key)
+    if prepared and prepared["sig"] != signature:
+        if os.path.exists(prepared["path"]):
+            os.remove(prepared["path"])
+        st.session_state.pop(state_key)
+        prepared = None
+
+    col_fmt, col_prep, col_dl = st.columns([1, 1, 1])
+    with col_fmt:
+        fmt = st.selectbox("Export format", list(EXPORT_FORMATS), key=f"{key}_fmt",
+                           label_visibility="collapsed")
+    with col_prep:
+        if st.button("📦 Prepare export", key=f"{key}_prep", use_container_width=True):
+            if prepared and os.path.exists(prepared["path"]):
+                os.remove(prepared["path"])
+            try:
+                with st.spinner("Exporting..."):
+                    path, rows = build_export(fmt, columns, make_batches())
+                prepared = {"sig": signature, "fmt": fmt, "path": path, "rows": rows}
+                st.session_state[state_key] = prepared
+            except Exception as e:
+                st.error(f"❌ Export failed: {e}")
+    with col_dl:
+        if prepared and prepared["fmt"] == fmt and os.path.exists(prepared["path"]):
+            ext, mime = EXPORT_FORMATS[fmt]
+            # download_button reads the whole file into Streamlit's media store on
+            # each rerun it is shown; the export is streamed to disk, not served from it
+            with open(prepared["path"], "rb") as fh:
+                st.download_button(f"📥 {fmt} ({prepared['rows']} rows)", fh,
+                                   f"{file_stem}_{datetime.now().strftime('%Y%m%d')}.{ext}",
+                                   mime, key=f"{key}_dl", use_container_width=True)
 
 # ============================================================
 # AUTHENTICATION
@@ -584,11 +2428,7 @@ with st.sidebar:
         emp_filter = user_employee_name or "All"
         st.info("📌 Your data only")
     else:
-        dept_rows = execute_query(
-            "SELECT DISTINCT department FROM kpi_entries WHERE department IS NOT NULL ORDER BY department",
-            fetch=True
-        ) or []
-        dept_list = [r[0] for r in dept_rows]
+        dept_list, all_emps, emps_by_dept = get_filter_dimensions()
 
         if user_role == "manager":
             dept_list = [d for d in dept_list if d == user_department]
@@ -598,15 +2438,7 @@ with st.sidebar:
         else:
             dept_filter = st.selectbox("🏢 Department", ["All"] + dept_list)
 
-        emp_q = "SELECT DISTINCT employee_name FROM kpi_entries WHERE employee_name IS NOT NULL"
-        emp_p = []
-        if dept_filter != "All":
-            emp_q += " AND department=%s"
-            emp_p.append(dept_filter)
-        emp_q += " ORDER BY employee_name"
-
-        emp_rows = execute_query(emp_q, emp_p, fetch=True) or []
-        emp_list = [r[0] for r in emp_rows]
+        emp_list = all_emps if dept_filter == "All" else emps_by_dept.get(dept_filter, [])
         emp_filter = st.selectbox("👤 Employee", ["All"] + emp_list)
 
     date_range = st.date_input("📅 Date Range", value=[])
@@ -614,7 +2446,7 @@ with st.sidebar:
 
     st.markdown("---")
     st.markdown("### 💾 Data Status")
-    total_saved = len(execute_query("SELECT id FROM kpi_entries", fetch=True) or [])
+    total_saved = get_entity_counts().get("kpi_entries", 0)
     st.success(f"✅ {total_saved} saved")
     st.info("🔒 Persistent")
 
@@ -652,6 +2484,10 @@ else:
     menu_options = ["Dashboard", "My Records"]
     menu_icons = ["speedometer2", "table"]
 
+if user_role != "employee" and get_setting("allow_import", "1") == "1":
+    menu_options.insert(2, "Import")
+    menu_icons.insert(2, "upload")
+
 menu = option_menu(
     None, menu_options, icons=menu_icons,
     default_index=0, orientation="horizontal",
@@ -666,40 +2502,15 @@ menu = option_menu(
 # ============================================================
 # QUERY KPI DATA
 # ============================================================
-q = """
-SELECT id, employee_name, department, kpi1, kpi2, kpi3, kpi4, total_score, rating,
-       created_at, COALESCE(created_by, 'system') as created_by
-FROM kpi_entries WHERE 1=1
-"""
-p = []
-
-if user_role == "employee":
-    q += " AND employee_name=%s"
-    p.append(user_employee_name)
-elif user_role == "manager":
-    q += " AND department=%s"
-    p.append(user_department)
+kpi_filters = KpiFilters(user_role, user_department, user_employee_name, dept_filter, emp_filter, rating_filter,
+                         tuple(date_range) if isinstance(date_range, (list, tuple)) else ())
+kpi_where, kpi_params = kpi_filter_sql(kpi_filters)
 
-if dept_filter != "All" and user_role == "admin":
-    q += " AND department=%s"
-    p.append(dept_filter)
-if emp_filter != "All" and user_role != "employee":
-    q += " AND employee_name=%s"
-    p.append(emp_filter)
-if rating_filter != "All":
-    q += " AND rating=%s"
-    p.append(rating_filter)
-if isinstance(date_range, (list, tuple)) and len(date_range) == 2:
-    q += " AND DATE(created_at) BETWEEN %s AND %s"
-    p += [str(date_range[0]), str(date_range[1])]
-
-q += " ORDER BY created_at DESC"
-
-rows = execute_query(q, p, fetch=True) or []
-df = pd.DataFrame(rows, columns=["ID", "Employee", "Department", "KPI1", "KPI2", "KPI3", "KPI4",
-                                 "Score", "Rating", "Created At", "Created By"])
-
-kpi1_lbl, kpi2_lbl, kpi3_lbl, kpi4_lbl = get_kpi_labels()
+page_data = PageData(menu, {
+    "kpi_aggregates": lambda: get_dashboard_aggregates(kpi_filters),
+    "kpi_monthly": lambda: get_monthly_rollup(kpi_filters, ["entry_month"]),
+    "kpi_labels": get_kpi_labels,
+})
 
 # ============================================================
 # DASHBOARD
@@ -710,16 +2521,15 @@ if menu == "Dashboard":
 
     col1, col2, col3, col4, col5 = st.columns(5)
 
-    total_records = len(df)
-    avg_score = round(float(df["Score"].mean()), 2) if total_records > 0 else 0
-    best_score = round(float(df["Score"].max()), 2) if total_records > 0 else 0
+    agg = page_data["kpi_aggregates"]
+    total_records = agg["count"]
+    avg_score = round(agg["avg"], 2) if total_records > 0 else 0
+    best_score = round(agg["max"], 2) if total_records > 0 else 0
 
-    if user_role == "admin":
-        active_emp = len(execute_query("SELECT id FROM employees WHERE is_active=TRUE", fetch=True) or [])
-        active_dept = len(execute_query("SELECT id FROM departments WHERE is_active=TRUE", fetch=True) or [])
-    elif user_role in ["manager", "hr"]:
-        active_emp = len(execute_query("SELECT id FROM employees WHERE is_active=TRUE", fetch=True) or [])
-        active_dept = len(execute_query("SELECT id FROM departments WHERE is_active=TRUE", fetch=True) or [])
+    if user_role in ["admin", "manager", "hr"]:
+        counts = get_entity_counts()
+        active_emp = counts.get("employees_active", 0)
+        active_dept = counts.get("departments_active", 0)
     else:
         active_emp = 1
         active_dept = 1
@@ -751,7 +2561,7 @@ if menu == "Dashboard":
 
     st.markdown("</div>", unsafe_allow_html=True)
 
-    if len(df) > 0:
+    if total_records > 0:
         st.write("")
 
         col_c1, col_c2 = st.columns([1.5, 1])
@@ -759,8 +2569,9 @@ if menu == "Dashboard":
         with col_c1:
             st.markdown('<div class="card">', unsafe_allow_html=True)
             st.subheader("📊 Rating Distribution")
-            rating_counts = df["Rating"].value_counts().reset_index()
-            rating_counts.columns = ["Rating", "Count"]
+            rating_counts = pd.DataFrame(
+                [(r, c) for r, c in agg["ratings"].items() if c > 0], columns=["Rating", "Count"]
+            ).sort_values("Count", ascending=False)
 
             colors = {
                 "Excellent": "#10b981",
@@ -779,7 +2590,7 @@ if menu == "Dashboard":
         with col_c2:
             st.markdown('<div class="card">', unsafe_allow_html=True)
             st.subheader("🎯 Performance")
-            total = len(df)
+            total = total_records
 
             for rating, color, emoji in [
                 ("Excellent", "#dcfce7", "🌟"),
@@ -787,7 +2598,7 @@ if menu == "Dashboard":
                 ("Average", "#fef3c7", "📊"),
                 ("Needs Improvement", "#fee2e2", "⚠️")
             ]:
-                cnt = len(df[df["Rating"] == rating])
+                cnt = agg["ratings"][rating]
                 pct = round(cnt / total * 100, 1) if total > 0 else 0
                 st.markdown(f"""
                 <div class='performance-box' style='background:{color}'>
@@ -804,8 +2615,7 @@ if menu == "Dashboard":
             with col_p1:
                 st.markdown('<div class="card">', unsafe_allow_html=True)
                 st.subheader("🏭 Department")
-                dept_avg = df.groupby("Department")["Score"].mean().reset_index()
-                dept_avg = dept_avg.sort_values("Score", ascending=False)
+                dept_avg = agg["departments"].sort_values("Score", ascending=False)
                 fig = px.bar(dept_avg, x="Department", y="Score",
                              color="Score", color_continuous_scale="Viridis", text="Score")
                 fig.update_traces(texttemplate='%{text:.2f}', textposition='outside')
@@ -816,8 +2626,7 @@ if menu == "Dashboard":
             with col_p2:
                 st.markdown('<div class="card">', unsafe_allow_html=True)
                 st.subheader("👤 Top 10")
-                top_emp = df.groupby("Employee")["Score"].mean().reset_index()
-                top_emp = top_emp.sort_values("Score", ascending=False).head(10)
+                top_emp = agg["employees"].sort_values("Score", ascending=False).head(10)
                 fig = px.bar(top_emp, x="Score", y="Employee", orientation='h',
                              color="Score", color_continuous_scale="RdYlGn", text="Score")
                 fig.update_traces(texttemplate='%{text:.2f}', textposition='outside')
@@ -828,9 +2637,7 @@ if menu == "Dashboard":
         st.write("")
         st.markdown('<div class="card">', unsafe_allow_html=True)
         st.subheader("📈 Monthly Trend")
-        tmp = df.copy()
-        tmp["Month"] = pd.to_datetime(tmp["Created At"]).dt.to_period("M").astype(str)
-        monthly = tmp.groupby("Month")["Score"].mean().reset_index().sort_values("Month")
+        monthly = page_data["kpi_monthly"].sort_values("Month")
 
         fig = go.Figure()
         fig.add_trace(go.Scatter(
@@ -851,6 +2658,7 @@ if menu == "Dashboard":
 if menu == "Entry":
     if not require_auth("manager"):  # manager or above (hr/admin ok)
         st.stop()
+    kpi1_lbl, kpi2_lbl, kpi3_lbl, kpi4_lbl = page_data["kpi_labels"]
 
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.subheader("➕ Add KPI Entry")
@@ -920,6 +2728,7 @@ if menu == "Entry":
             """, [emp, dept, v1, v2, v3, v4, score, rating, now, month, username])
 
             if result:
+                bump_generation("kpi_entries")
                 log_action(username, "CREATE_KPI", f"{emp} - {score}")
                 st.success(f"✅ Saved! **Score:** {score} | **Rating:** {rating}")
                 st.info("💾 Data permanently saved to database!")
@@ -932,18 +2741,112 @@ if menu == "Entry":
 
     st.markdown("</div>", unsafe_allow_html=True)
 
+# ============================================================
+# IMPORT (CSV / Excel)
+# ============================================================
+if menu == "Import":
+    if not require_auth("manager"):
+        st.stop()
+    kpi1_lbl, kpi2_lbl, kpi3_lbl, kpi4_lbl = page_data["kpi_labels"]
+
+    st.markdown('<div class="card">', unsafe_allow_html=True)
+    st.subheader("📤 Bulk Import")
+    st.caption(f"Columns: employee_name, kpi1-kpi4 (or {kpi1_lbl}, {kpi2_lbl}, {kpi3_lbl}, {kpi4_lbl}), "
+               "optional department and date. Score and rating use the current weights and rules.")
+
+    uploaded = st.file_uploader("CSV or Excel file", type=["csv", "xlsx"])
+
+    if uploaded:
+        # Dry run once per uploaded file; widget reruns reuse the preview
+        if st.session_state.get("import_file_id") != uploaded.file_id:
+            try:
+                with st.spinner("🔍 Validating..."):
+                    st.session_state["import_preview"] = run_kpi_import(uploaded, user_role, user_department,
+                                                                        username, dry_run=True)
+                st.session_state["import_file_id"] = uploaded.file_id
+            except Exception as e:
+                st.session_state.pop("import_file_id", None)
+                st.error(f"❌ Could not read file: {str(e)}")
+                st.stop()
+        preview = st.session_state["import_preview"]
+
+        col1, col2, col3 = st.columns(3)
+        col1.metric("📄 Rows", preview["rows"])
+        col2.metric("✅ Valid", preview["valid"])
+        col3.metric("⚠️ Errors", len(preview["errors"]))
+
+        st.markdown("#### 👀 Preview (dry run)")
+        st.dataframe(preview["preview"].rename(columns={
+            "kpi1": kpi1_lbl, "kpi2": kpi2_lbl, "kpi3": kpi3_lbl, "kpi4": kpi4_lbl
+        }), use_container_width=True, hide_index=True)
+
+        if len(preview["errors"]):
+            st.markdown("#### ⚠️ Row Errors")
+            st.dataframe(preview["errors"].head(500), use_container_width=True, hide_index=True)
+            st.download_button("📥 Error Report", preview["errors"].to_csv(index=False).encode('utf-8'),
+                               f"import_errors_{datetime.now().strftime('%Y%m%d')}.csv", "text/csv")
+
+        # The uploader keeps its file after an import; the same upload must not be saved twice
+        if st.session_state.get("import_done_id") == uploaded.file_id:
+            st.info("✅ This file has been imported. Upload another file to import more.")
+        elif preview["valid"] > 0:
+            if st.button(f"✅ Import {preview['valid']} valid rows", use_container_width=True, type="primary"):
+                try:
+                    with st.spinner("💾 Importing..."):
+                        result = run_kpi_import(uploaded, user_role, user_department, username, dry_run=False)
+                    bump_generation("kpi_entries")
+                    log_action(username, "IMPORT_KPI", f"{result['inserted']} rows from {uploaded.name}")
+                    st.session_state["import_done_id"] = uploaded.file_id
+                    st.success(f"✅ Imported {result['inserted']} rows "
+                               f"({len(result['errors'])} skipped with errors)")
+                except Exception as e:
+                    st.error(f"❌ Import failed, nothing was saved: {str(e)}")
+
+    st.markdown("</div>", unsafe_allow_html=True)
+
 # ============================================================
 # RECORDS / MY RECORDS
 # ============================================================
 if menu in ["Records", "My Records"]:
     if menu == "Records" and not require_auth("manager"):
         st.stop()
+    kpi1_lbl, kpi2_lbl, kpi3_lbl, kpi4_lbl = page_data["kpi_labels"]
 
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.subheader(f"📋 {menu}")
 
-    if len(df) > 0:
-        show_df = df.drop(columns=["ID"]).rename(columns={
+    col_f1, col_f2, col_f3, col_f4 = st.columns([2, 2, 2, 1])
+
+    with col_f1:
+        sort_label = st.selectbox("Sort", list(RECORD_SORTS.keys()), key="rec_sort")
+    with col_f2:
+        emp_search = st.text_input("Employee contains", key="rec_emp_search") if user_role != "employee" else ""
+    with col_f3:
+        score_range = st.slider("Score", 0, 100, (0, 100), key="rec_score")
+    with col_f4:
+        page_size = st.selectbox("Rows", [25, 50, 100, 200], key="rec_page_size")
+
+    rec_where, rec_params = kpi_where, list(kpi_params)
+    if emp_search.strip():
+        rec_where += " AND employee_name ILIKE %s"
+        rec_params.append(f"%{emp_search.strip()}%")
+    if score_range != (0, 100):
+        rec_where += " AND total_score BETWEEN %s AND %s"
+        rec_params += [score_range[0], score_range[1]]
+
+    # Any change to filters, sort or page size starts again from page 1
+    page_sig = (rec_where, tuple(rec_params), sort_label, page_size)
+    if st.session_state.get("rec_page_sig") != page_sig:
+        st.session_state["rec_page_sig"] = page_sig
+        st.session_state["rec_cursors"] = []
+    cursors = st.session_state["rec_cursors"]
+
+    page_rows, has_next = fetch_records_page(rec_where, rec_params, sort_label,
+                                             cursors[-1] if cursors else None, page_size)
+    total_count = count_kpi_entries(rec_where, rec_params)
+
+    if page_rows:
+        show_df = kpi_frame_from_rows(page_rows).rename(columns={
             "KPI1": kpi1_lbl, "KPI2": kpi2_lbl,
             "KPI3": kpi3_lbl, "KPI4": kpi4_lbl
         })
@@ -960,85 +2863,107 @@ if menu in ["Records", "My Records"]:
         styled_df = show_df.style.apply(highlight_rating, axis=1)
         st.dataframe(styled_df, use_container_width=True, hide_index=True)
 
-        st.markdown("---")
-        col1, col2, col3 = st.columns([2, 1, 1])
+        col_n1, col_n2, col_n3 = st.columns([1, 2, 1])
 
-        with col1:
-            st.markdown(f"**Total:** {len(df)} records (💾 Permanently saved)")
+        with col_n1:
+            if st.button("⬅️ Prev", use_container_width=True, disabled=not cursors):
+                cursors.pop()
+                st.rerun()
 
-        with col2:
-            csv = df.to_csv(index=False).encode('utf-8')
-            st.download_button("📥 CSV", csv,
-                               f"kpi_{datetime.now().strftime('%Y%m%d')}.csv",
-                               "text/csv", use_container_width=True)
+        with col_n2:
+            st.markdown(f"<div style='text-align:center'>Page {len(cursors) + 1} • "
+                        f"{total_count} matching records</div>", unsafe_allow_html=True)
 
-        with col3:
-            st.download_button("📊 Excel", csv,
-                               f"kpi_{datetime.now().strftime('%Y%m%d')}.csv",
-                               "application/vnd.ms-excel", use_container_width=True)
+        with col_n3:
+            if st.button("Next ➡️", use_container_width=True, disabled=not has_next):
+                cursors.append(record_sort_key(page_rows[-1], sort_label))
+                st.rerun()
+
+        st.markdown("---")
+        st.markdown(f"**Total:** {total_count} records (💾 Permanently saved)")
+
+        export_sql = f"""
+            SELECT {RECORD_COLUMNS}
+            FROM kpi_entries{rec_where}
+            ORDER BY created_at DESC, id DESC
+        """
+        export_panel("rec", "kpi", list(show_df.columns),
+                     lambda: iter_query_batches(export_sql, rec_params),
+                     (rec_where, tuple(rec_params), tuple(show_df.columns)))
     else:
         st.info("📌 No records. Once added, data will be saved permanently.")
 
     st.markdown("</div>", unsafe_allow_html=True)
 
     # Edit/Delete
-    if user_role in ["admin", "manager", "hr"] and len(df) > 0 and get_setting("allow_edit_delete", "1") == "1":
+    if user_role in ["admin", "manager", "hr"] and get_setting("allow_edit_delete", "1") == "1":
         st.write("")
         st.markdown('<div class="card">', unsafe_allow_html=True)
         st.subheader("✏️ Edit / Delete")
 
-        rec_id = st.selectbox("Select Record", df["ID"].tolist())
-        row = df[df["ID"] == rec_id].iloc[0]
-
-        col_e1, col_e2 = st.columns([2, 1])
-
-        with col_e1:
-            st.markdown("#### Edit Values")
-            col_k1, col_k2, col_k3, col_k4 = st.columns(4)
-
-            with col_k1:
-                ek1 = st.number_input(kpi1_lbl, 1, 100, int(row["KPI1"]), key="ek1")
-            with col_k2:
-                ek2 = st.number_input(kpi2_lbl, 1, 100, int(row["KPI2"]), key="ek2")
-            with col_k3:
-                ek3 = st.number_input(kpi3_lbl, 1, 100, int(row["KPI3"]), key="ek3")
-            with col_k4:
-                ek4 = st.number_input(kpi4_lbl, 1, 100, int(row["KPI4"]), key="ek4")
-
-        with col_e2:
-            st.markdown("#### Current")
-            st.info(f"**Employee:** {row['Employee']}")
-            st.info(f"**Dept:** {row['Department']}")
-            st.info(f"**Score:** {row['Score']}")
-            st.info(f"**Rating:** {row['Rating']}")
+        rec_search = st.text_input("🔎 Find record", placeholder="Record ID or employee name", key="rec_find")
+        matches = search_kpi_entries(kpi_where, kpi_params, rec_search)
 
-            new_score = calc_weighted_score(ek1, ek2, ek3, ek4)
-            new_rating = calc_rating(new_score)
-            st.success(f"**New Score:** {new_score}")
-            st.success(f"**New Rating:** {new_rating}")
-
-        st.markdown("---")
-        col_b1, col_b2, col_b3 = st.columns([1, 1, 2])
+        if matches:
+            match_labels = {m[0]: f"#{m[0]} • {m[1]} • {m[2]:%Y-%m-%d} • {m[3]}" for m in matches}
+            rec_id = st.selectbox("Select Record", list(match_labels.keys()), format_func=match_labels.get)
+            row = get_kpi_entry(kpi_where, kpi_params, rec_id)
+        else:
+            st.info("📌 No matching records")
+            row = None
+
+        if row is not None:
+            col_e1, col_e2 = st.columns([2, 1])
+
+            with col_e1:
+                st.markdown("#### Edit Values")
+                col_k1, col_k2, col_k3, col_k4 = st.columns(4)
+
+                with col_k1:
+                    ek1 = st.number_input(kpi1_lbl, 1, 100, int(row["KPI1"]), key="ek1")
+                with col_k2:
+                    ek2 = st.number_input(kpi2_lbl, 1, 100, int(row["KPI2"]), key="ek2")
+                with col_k3:
+                    ek3 = st.number_input(kpi3_lbl, 1, 100, int(row["KPI3"]), key="ek3")
+                with col_k4:
+                    ek4 = st.number_input(kpi4_lbl, 1, 100, int(row["KPI4"]), key="ek4")
+
+            with col_e2:
+                st.markdown("#### Current")
+                st.info(f"**Employee:** {row['Employee']}")
+                st.info(f"**Dept:** {row['Department']}")
+                st.info(f"**Score:** {row['Score']}")
+                st.info(f"**Rating:** {row['Rating']}")
+
+                new_score = calc_weighted_score(ek1, ek2, ek3, ek4)
+                new_rating = calc_rating(new_score)
+                st.success(f"**New Score:** {new_score}")
+                st.success(f"**New Rating:** {new_rating}")
 
-        with col_b1:
-            if st.button("💾 Update", use_container_width=True, type="primary"):
-                execute_query("""
-                    UPDATE kpi_entries
-                    SET kpi1=%s, kpi2=%s, kpi3=%s, kpi4=%s, total_score=%s, rating=%s,
-                        updated_by=%s, updated_at=%s
-                    WHERE id=%s
-                """, [ek1, ek2, ek3, ek4, new_score, new_rating, username, datetime.now(), rec_id])
-
-                log_action(username, "UPDATE_KPI", f"ID {rec_id}")
-                st.success("✅ Updated!")
-                st.rerun()
+            st.markdown("---")
+            col_b1, col_b2, col_b3 = st.columns([1, 1, 2])
+
+            with col_b1:
+                if st.button("💾 Update", use_container_width=True, type="primary"):
+                    execute_query("""
+                        UPDATE kpi_entries
+                        SET kpi1=%s, kpi2=%s, kpi3=%s, kpi4=%s, total_score=%s, rating=%s,
+                            updated_by=%s, updated_at=%s
+                        WHERE id=%s
+                    """, [ek1, ek2, ek3, ek4, new_score, new_rating, username, datetime.now(), rec_id])
+
+                    bump_generation("kpi_entries")
+                    log_action(username, "UPDATE_KPI", f"ID {rec_id}")
+                    st.success("✅ Updated!")
+                    st.rerun()
 
-        with col_b2:
-            if st.button("🗑️ Delete", use_container_width=True):
-                execute_query("DELETE FROM kpi_entries WHERE id=%s", [rec_id])
-                log_action(username, "DELETE_KPI", f"ID {rec_id}")
-                st.warning("🗑️ Deleted!")
-                st.rerun()
+            with col_b2:
+                if st.button("🗑️ Delete", use_container_width=True):
+                    execute_query("DELETE FROM kpi_entries WHERE id=%s", [rec_id])
+                    bump_generation("kpi_entries")
+                    log_action(username, "DELETE_KPI", f"ID {rec_id}")
+                    st.warning("🗑️ Deleted!")
+                    st.rerun()
 
         st.markdown("</div>", unsafe_allow_html=True)
 
@@ -1052,11 +2977,9 @@ if menu == "Reports":
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.subheader("📊 Reports")
 
-    if len(df) > 0:
-        tmp = df.copy()
-        tmp["Month"] = pd.to_datetime(tmp["Created At"]).dt.to_period("M").astype(str)
-        months = sorted(tmp["Month"].unique())[::-1]
+    months = sorted(page_data["kpi_monthly"]["Month"])[::-1]
 
+    if len(months) > 0:
         col1, col2, col3 = st.columns(3)
 
         with col1:
@@ -1071,21 +2994,21 @@ if menu == "Reports":
         m_from = min(sel_month_from, sel_month_to)
         m_to = max(sel_month_from, sel_month_to)
 
-        mdf = tmp[(tmp["Month"] >= m_from) & (tmp["Month"] <= m_to)]
-
         st.markdown("---")
 
         if report_type == "Salary Increment":
             st.markdown(f"**Range:** {m_from} to {m_to}")
 
-            rep = mdf.groupby(["Employee", "Department"])["Score"].mean().reset_index()
+            rep = get_monthly_rollup(kpi_filters, ["employee_name", "department"], m_from, m_to)
+            rep = rep.sort_values(["Employee", "Department"]).reset_index(drop=True)
             rep["Avg Score"] = rep["Score"].round(2)
-            rep.drop(columns=["Score"], inplace=True)
+            rep.drop(columns=["Count", "Score"], inplace=True)
 
-            rep["Rating"] = rep["Avg Score"].apply(lambda s: calc_rating(float(s)))
-            rep["Increment %"] = rep["Avg Score"].apply(lambda s: calc_increment_percent(float(s)))
+            policy = get_scoring_policy()
+            rep["Rating"] = policy.rating_series(rep["Avg Score"])
+            rep["Increment %"] = policy.increment_series(rep["Rating"])
 
-            rep["Base Salary"] = rep["Employee"].apply(lambda e: get_employee_base_salary(e))
+            rep["Base Salary"] = rep["Employee"].map(get_all_base_salaries()).fillna(0.0).astype(float)
             rep["Increase Amount"] = (rep["Base Salary"] * rep["Increment %"] / 100.0).round(2)
             rep["New Salary"] = (rep["Base Salary"] + rep["Increase Amount"]).round(2)
 
@@ -1093,20 +3016,22 @@ if menu == "Reports":
 
             st.dataframe(rep, use_container_width=True, hide_index=True)
 
-            csv = rep.to_csv(index=False).encode('utf-8')
-            st.download_button("📥 Download Salary Increment Report", csv,
-                               f"salary_increment_{m_from}_to_{m_to}.csv", "text/csv")
+            export_panel("rep_salary", f"salary_increment_{m_from}_to_{m_to}", list(rep.columns),
+                         lambda: iter_frame_batches(rep),
+                         (kpi_filters, m_from, m_to, tuple(rep.columns), len(rep)))
         else:
             chart_type = st.selectbox("Chart", ["Bar", "Line", "Pie"])
 
             if report_type == "Employee Average":
-                rep = mdf.groupby("Employee")["Score"].mean().reset_index().sort_values("Score", ascending=False)
+                rep = get_monthly_rollup(kpi_filters, ["employee_name"], m_from, m_to).drop(columns=["Count"])
+                rep = rep.sort_values("Score", ascending=False)
                 x, y = "Employee", "Score"
             elif report_type == "Department Average":
-                rep = mdf.groupby("Department")["Score"].mean().reset_index().sort_values("Score", ascending=False)
+                rep = get_monthly_rollup(kpi_filters, ["department"], m_from, m_to).drop(columns=["Count"])
+                rep = rep.sort_values("Score", ascending=False)
                 x, y = "Department", "Score"
             else:
-                rep = mdf[["Employee", "Department", "Score", "Rating"]].copy()
+                rep = get_detailed_report(kpi_filters, m_from, m_to)
                 x, y = "Employee", "Score"
 
             if chart_type == "Bar":
@@ -1124,8 +3049,9 @@ if menu == "Reports":
             st.markdown("---")
             st.dataframe(rep, use_container_width=True, hide_index=True)
 
-            csv = rep.to_csv(index=False).encode('utf-8')
-            st.download_button("📥 Download", csv, f"report_{m_from}_to_{m_to}.csv", "text/csv")
+            export_panel("rep", f"report_{m_from}_to_{m_to}", list(rep.columns),
+                         lambda: iter_frame_batches(rep),
+                         (report_type, kpi_filters, m_from, m_to, tuple(rep.columns), len(rep)))
     else:
         st.info("📌 No data for reports")
 
@@ -1170,6 +3096,7 @@ if menu == "Employees":
                     """, [emp_name.strip(), emp_dept, emp_active, datetime.now()])
 
                     if result:
+                        bump_generation("employees")
                         log_action(username, "ADD_EMPLOYEE", emp_name)
                         st.success(f"✅ Added '{emp_name}'!")
                         st.rerun()
@@ -1181,14 +3108,12 @@ if menu == "Employees":
     with tab2:
         st.markdown("### Manage Employees")
 
-        emps = get_all_employees()
-        if user_role == "manager" and user_department:
-            emps = [e for e in emps if e[2] == user_department]
+        emps = get_employee_roster(user_department if user_role == "manager" else None)
 
         if emps:
-            emp_df = pd.DataFrame(emps, columns=["ID", "Name", "Dept", "Active", "Created"])
+            emp_df = pd.DataFrame(emps, columns=["ID", "Name", "Dept", "Active", "Created", "Base Salary"])
             emp_df["Status"] = emp_df["Active"].apply(lambda x: "✅" if x else "❌")
-            emp_df["Base Salary"] = emp_df["Name"].apply(get_employee_base_salary)
+            emp_df["Base Salary"] = emp_df["Base Salary"].astype(float)
 
             st.dataframe(emp_df[["Name", "Dept", "Status", "Base Salary", "Created"]],
                          use_container_width=True, hide_index=True)
@@ -1200,7 +3125,7 @@ if menu == "Employees":
 
             if emp_sel:
                 emp_data = [e for e in emps if e[1] == emp_sel][0]
-                emp_id, emp_name, emp_dept, emp_active, _ = emp_data
+                emp_id, emp_name, emp_dept, emp_active, _, cur_sal = emp_data
 
                 col1, col2 = st.columns(2)
 
@@ -1217,7 +3142,6 @@ if menu == "Employees":
                         st.info(f"Dept: **{emp_dept}**")
 
                     st.markdown("#### 💰 Salary")
-                    cur_sal = get_employee_base_salary(emp_name)
                     new_sal = st.number_input("Base Salary", min_value=0.0, value=float(cur_sal), step=500.0, key="bsal")
 
                 with col2:
@@ -1228,34 +3152,38 @@ if menu == "Employees":
 
                 with col_b1:
                     if st.button("💾 Update", use_container_width=True, type="primary"):
-                        execute_query("""
+                        uow = UnitOfWork().add("""
                             UPDATE employees
                             SET employee_name=%s, department=%s, is_active=%s, updated_at=%s
                             WHERE id=%s
                         """, [new_name.strip(), new_dept, new_active, datetime.now(), emp_id])
 
                         # salary update
-                        set_employee_base_salary(new_name.strip(), new_sal)
+                        set_employee_base_salary(new_name.strip(), new_sal, uow)
 
-                        log_action(username, "UPDATE_EMPLOYEE", f"{emp_name} -> {new_name}")
-                        st.success("✅ Updated!")
-                        st.rerun()
+                        if uow.commit():
+                            bump_generation("employees", "employee_salary", "kpi_entries")
+                            log_action(username, "UPDATE_EMPLOYEE", f"{emp_name} -> {new_name}")
+                            st.success("✅ Updated!")
+                            st.rerun()
 
                 with col_b2:
                     if st.button("💾 Save Salary Only", use_container_width=True):
                         set_employee_base_salary(emp_name, new_sal)
+                        bump_generation("employee_salary")
                         log_action(username, "UPDATE_SALARY", f"{emp_name} = {new_sal}")
                         st.success("✅ Salary Saved!")
                         st.rerun()
 
                 with col_b3:
                     if st.button("🗑️ Delete", use_container_width=True) and user_role == "admin":
-                        entries = execute_query("SELECT COUNT(*) FROM kpi_entries WHERE employee_name=%s",
-                                                [emp_name], fetch_one=True)
+                        entries = execute_query("SELECT COUNT(*) FROM kpi_entries WHERE employee_id=%s",
+                                                [emp_id], fetch_one=True)
                         if entries and entries[0] > 0:
                             st.error(f"⚠️ Cannot delete! {entries[0]} entries exist")
                         else:
                             execute_query("DELETE FROM employees WHERE id=%s", [emp_id])
+                            bump_generation("employees")
                             log_action(username, "DELETE_EMPLOYEE", emp_name)
                             st.success("🗑️ Deleted!")
                             st.rerun()
@@ -1300,6 +3228,7 @@ if menu == "Departments":
                         """, [dept_name.strip(), dept_active, datetime.now()])
 
                         if result:
+                            bump_generation("departments")
                             log_action(username, "ADD_DEPARTMENT", dept_name)
                             st.success(f"✅ Added '{dept_name}'!")
                             st.balloons()
@@ -1312,17 +3241,12 @@ if menu == "Departments":
     with tab2:
         st.markdown("### Manage Departments")
 
-        depts = get_all_departments()
+        depts = get_department_roster()
 
         if depts:
-            dept_df = pd.DataFrame(depts, columns=["ID", "Name", "Active", "Created"])
+            dept_df = pd.DataFrame(depts, columns=["ID", "Name", "Active", "Created", "Employees"])
             dept_df["Status"] = dept_df["Active"].apply(lambda x: "✅" if x else "❌")
 
-            for idx, row in dept_df.iterrows():
-                emp_count = execute_query("SELECT COUNT(*) FROM employees WHERE department=%s",
-                                          [row["Name"]], fetch_one=True)
-                dept_df.at[idx, "Employees"] = emp_count[0] if emp_count else 0
-
             st.dataframe(dept_df[["Name", "Status", "Employees", "Created"]],
                          use_container_width=True, hide_index=True)
 
@@ -1333,7 +3257,7 @@ if menu == "Departments":
 
             if dept_sel:
                 dept_data = [d for d in depts if d[1] == dept_sel][0]
-                dept_id, dept_name, dept_active, _ = dept_data
+                dept_id, dept_name, dept_active, _, _ = dept_data
 
                 col1, col2 = st.columns(2)
 
@@ -1362,18 +3286,20 @@ if menu == "Departments":
                                 WHERE id=%s
                             """, [new_dept_name.strip(), new_dept_active, dept_id])
 
+                            bump_generation("departments", "employees", "kpi_entries")
                             log_action(username, "UPDATE_DEPARTMENT", f"{dept_name} → {new_dept_name}")
                             st.success("✅ Updated!")
                             st.rerun()
 
                 with col_b2:
                     if st.button("🗑️ Delete", use_container_width=True):
-                        emp_count = execute_query("SELECT COUNT(*) FROM employees WHERE department=%s",
-                                                 [dept_name], fetch_one=True)
+                        emp_count = execute_query("SELECT COUNT(*) FROM employees WHERE department_id=%s",
+                                                 [dept_id], fetch_one=True)
                         if emp_count and emp_count[0] > 0:
                             st.error(f"⚠️ Cannot delete! {emp_count[0]} employees in this dept")
                         else:
                             execute_query("DELETE FROM departments WHERE id=%s", [dept_id])
+                            bump_generation("departments")
                             log_action(username, "DELETE_DEPARTMENT", dept_name)
                             st.success("🗑️ Deleted!")
                             st.rerun()
@@ -1446,6 +3372,7 @@ if menu == "Users":
                           new_emp_name or None, new_dept or None, new_active, username])
 
                     if result:
+                        bump_generation("users")
                         log_action(username, "CREATE_USER", f"{new_username} ({new_role})")
                         st.success(f"✅ User '{new_username}' created!")
                         st.balloons()
@@ -1514,6 +3441,7 @@ if menu == "Users":
                             else:
                                 st.error("⚠️ Password 6+ chars and match")
 
+                        bump_generation("users")
                         log_action(username, "UPDATE_USER", uname)
                         st.success("✅ Updated!")
                         st.rerun()
@@ -1521,6 +3449,7 @@ if menu == "Users":
                 with col_b2:
                     if st.button("🗑️ Delete", use_container_width=True):
                         execute_query("DELETE FROM users WHERE username=%s", [uname])
+                        bump_generation("users")
                         log_action(username, "DELETE_USER", uname)
                         st.success("🗑️ Deleted!")
                         st.rerun()
@@ -1539,44 +3468,122 @@ if menu == "Audit Log":
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.subheader("📋 Audit Trail")
 
-    col1, col2, col3 = st.columns(3)
+    col1, col2, col3, col4 = st.columns(4)
 
+    # audit_log is partitioned by month; the date range limits every query below
+    # to the partitions it covers
     with col1:
-        all_users = execute_query("SELECT DISTINCT username FROM audit_log ORDER BY username", fetch=True) or []
-        user_list = [u[0] for u in all_users]
-        filter_user = st.selectbox("User", ["All"] + user_list)
+        today = datetime.now().date()
+        audit_dates = st.date_input("📅 Date Range", value=(today - timedelta(days=30), today), key="audit_dates")
+        audit_dates = tuple(audit_dates) if isinstance(audit_dates, (list, tuple)) else (audit_dates,)
+        if not audit_dates:
+            audit_dates = (today,)
+        date_from, date_to = audit_dates[0], audit_dates[-1]
+
+    range_sql = " AND timestamp >= %s::date AND timestamp < %s::date + 1"
+    range_p = [str(date_from), str(date_to)]
+
+    audit_facets = load_audit_facets()
 
     with col2:
-        all_actions = execute_query("SELECT DISTINCT action FROM audit_log ORDER BY action", fetch=True) or []
-        action_list = [a[0] for a in all_actions]
-        filter_action = st.selectbox("Action", ["All"] + action_list)
+        filter_user = st.selectbox("User", ["All"] + audit_facets["username"])
 
     with col3:
-        limit = st.selectbox("Records", [50, 100, 200, 500], index=1)
+        filter_action = st.selectbox("Action", ["All"] + audit_facets["action"])
+
+    with col4:
+        page_size = st.selectbox("Page Size", [50, 100, 200, 500], index=1)
+
+    audit_search = st.text_input("🔍 Search", key="audit_search",
+                                 placeholder='e.g. 4521 · Rahul salary · "UPDATE_KPI" -Asha').strip()
 
-    audit_q = "SELECT username, action, details, timestamp FROM audit_log WHERE 1=1"
-    audit_p = []
+    audit_where = f" WHERE 1=1{range_sql}"
+    audit_p = list(range_p)
+
+    # websearch syntax: words are ANDed, "quoted phrases", OR, -excluded
+    if audit_search:
+        audit_where += " AND search_tsv @@ websearch_to_tsquery('simple', %s)"
+        audit_p.append(audit_search)
 
     if filter_user != "All":
-        audit_q += " AND username=%s"
+        audit_where += " AND username=%s"
         audit_p.append(filter_user)
 
     if filter_action != "All":
-        audit_q += " AND action=%s"
+        audit_where += " AND action=%s"
         audit_p.append(filter_action)
 
-    audit_q += f" ORDER BY timestamp DESC LIMIT {limit}"
+    # Keyset "load more": rows already shown stay in the session, the next page
+    # seeks past the last (timestamp, id) instead of growing a LIMIT/OFFSET.
+    audit_sig = (audit_where, tuple(audit_p), page_size)
+    audit_gen = get_audit_sink().generation()
+    if st.session_state.get("audit_sig") != audit_sig:
+        st.session_state["audit_sig"] = audit_sig
+        st.session_state["audit_gen"] = audit_gen
+        st.session_state["audit_rows"] = []
+        st.session_state["audit_more"] = True
+        st.session_state["audit_sparse"] = bool(audit_search) and audit_search_is_sparse(audit_where, audit_p)
+    audit_rows = st.session_state["audit_rows"]
+    # "+ INTERVAL '0'" hides the timestamp index so the planner uses the GIN bitmap instead
+    order_sql = ("timestamp + INTERVAL '0 seconds' DESC, id DESC" if st.session_state["audit_sparse"]
+                 else "timestamp DESC, id DESC")
+
+    def fetch_audit_rows(seek_sql, seek_p, limit):
+        details_sql, details_p = "details", []
+        if audit_search:
+            details_sql = ("ts_headline('simple', COALESCE(details, ''), websearch_to_tsquery('simple', %s), "
+                           "'StartSel=«, StopSel=», MaxFragments=2')")
+            details_p = [audit_search]
+        return execute_query(f"""
+            SELECT username, action, {details_sql}, timestamp, id FROM audit_log{audit_where}{seek_sql}
+            ORDER BY {order_sql}
+            LIMIT %s
+        """, details_p + list(audit_p) + seek_p + [limit], fetch=True, read_only=True, query_class="report") or []
+
+    def load_audit_page():
+        seek_sql, seek_p = "", []
+        if audit_rows:
+            seek_sql, seek_p = " AND (timestamp, id) < (%s, %s)", [audit_rows[-1][3], audit_rows[-1][4]]
+        rows = fetch_audit_rows(seek_sql, seek_p, page_size + 1)
+        audit_rows.extend(rows[:page_size])
+        st.session_state["audit_more"] = len(rows) > page_size
+
+    # Entries written since the last rerun go on top of the pages already loaded;
+    # after more than a page of them, start again from the newest
+    if st.session_state["audit_gen"] != audit_gen:
+        st.session_state["audit_gen"] = audit_gen
+        if audit_rows:
+            newer = fetch_audit_rows(" AND (timestamp, id) > (%s, %s)", [audit_rows[0][3], audit_rows[0][4]],
+                                     page_size + 1)
+            if len(newer) > page_size:
+                audit_rows.clear()
+                st.session_state["audit_more"] = True
+            else:
+                audit_rows[:0] = newer
+        else:
+            st.session_state["audit_more"] = True
 
-    logs = execute_query(audit_q, audit_p, fetch=True) or []
+    if not audit_rows and st.session_state["audit_more"]:
+        load_audit_page()
 
-    if logs:
+    if audit_rows:
         st.markdown("---")
-        log_df = pd.DataFrame(logs, columns=["User", "Action", "Details", "Time"])
+        log_df = pd.DataFrame([r[:4] for r in audit_rows], columns=["User", "Action", "Details", "Time"])
         st.dataframe(log_df, use_container_width=True, hide_index=True)
 
-        csv = log_df.to_csv(index=False).encode('utf-8')
-        st.download_button("📥 Export", csv,
-                           f"audit_{datetime.now().strftime('%Y%m%d')}.csv", "text/csv")
+        col_m1, col_m2 = st.columns([3, 1])
+        col_m1.caption(f"Showing {len(audit_rows)} entries from {date_from} to {date_to}"
+                       + (" • matches marked «like this»" if audit_search else ""))
+        with col_m2:
+            if st.button("⬇️ Load more", use_container_width=True, disabled=not st.session_state["audit_more"]):
+                load_audit_page()
+                st.rerun()
+
+        # The export covers every matching entry, not just the rows on screen
+        audit_q = f"SELECT username, action, details, timestamp FROM audit_log{audit_where} ORDER BY timestamp DESC, id DESC"
+        export_panel("audit", "audit", list(log_df.columns),
+                     lambda: iter_query_batches(audit_q, audit_p),
+                     audit_sig[:2])
     else:
         st.info("📌 No logs")
 
@@ -1588,6 +3595,7 @@ if menu == "Audit Log":
 if menu == "Settings":
     if not require_auth("admin"):
         st.stop()
+    kpi1_lbl, kpi2_lbl, kpi3_lbl, kpi4_lbl = page_data["kpi_labels"]
 
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.subheader("⚙️ Settings")
@@ -1609,13 +3617,14 @@ if menu == "Settings":
             n4 = st.text_input("KPI 4", value=k4, key="kl4")
 
         if st.button("💾 Save Labels", use_container_width=True, type="primary"):
-            execute_query("UPDATE kpi_master SET kpi_label=%s WHERE kpi_key='kpi1'", [n1.strip() or "KPI 1"])
-            execute_query("UPDATE kpi_master SET kpi_label=%s WHERE kpi_key='kpi2'", [n2.strip() or "KPI 2"])
-            execute_query("UPDATE kpi_master SET kpi_label=%s WHERE kpi_key='kpi3'", [n3.strip() or "KPI 3"])
-            execute_query("UPDATE kpi_master SET kpi_label=%s WHERE kpi_key='kpi4'", [n4.strip() or "KPI 4"])
-            log_action(username, "UPDATE_LABELS", "Labels updated")
-            st.success("✅ Saved!")
-            st.rerun()
+            uow = UnitOfWork()
+            for i, label in enumerate([n1, n2, n3, n4], start=1):
+                uow.add("UPDATE kpi_master SET kpi_label=%s WHERE kpi_key=%s", [label.strip() or f"KPI {i}", f"kpi{i}"])
+            if uow.commit():
+                invalidate_scoring_policy()
+                log_action(username, "UPDATE_LABELS", "Labels updated")
+                st.success("✅ Saved!")
+                st.rerun()
 
     with tab2:
         st.markdown("### KPI Weights (Must total 100%)")
@@ -1640,13 +3649,14 @@ if menu == "Settings":
 
         if st.button("💾 Save Weights", use_container_width=True, type="primary"):
             if total == 100:
-                execute_query("UPDATE kpi_weights SET weight=%s WHERE kpi_key='kpi1'", [nw1])
-                execute_query("UPDATE kpi_weights SET weight=%s WHERE kpi_key='kpi2'", [nw2])
-                execute_query("UPDATE kpi_weights SET weight=%s WHERE kpi_key='kpi3'", [nw3])
-                execute_query("UPDATE kpi_weights SET weight=%s WHERE kpi_key='kpi4'", [nw4])
-                log_action(username, "UPDATE_WEIGHTS", f"{nw1},{nw2},{nw3},{nw4}")
-                st.success("✅ Saved!")
-                st.rerun()
+                uow = UnitOfWork()
+                for i, weight in enumerate([nw1, nw2, nw3, nw4], start=1):
+                    uow.add("UPDATE kpi_weights SET weight=%s WHERE kpi_key=%s", [weight, f"kpi{i}"])
+                if uow.commit():
+                    invalidate_scoring_policy()
+                    log_action(username, "UPDATE_WEIGHTS", f"{nw1},{nw2},{nw3},{nw4}")
+                    st.success("✅ Saved!")
+                    st.rerun()
             else:
                 st.error("⚠️ Total must be 100%")
 
@@ -1678,6 +3688,7 @@ if menu == "Settings":
                     SET excellent_min=%s, good_min=%s, average_min=%s
                     WHERE id=1
                 """, [nex, ngd, nav])
+                invalidate_scoring_policy()
                 log_action(username, "UPDATE_RATINGS", f"{nex},{ngd},{nav}")
                 st.success("✅ Saved!")
                 st.rerun()
@@ -1705,13 +3716,16 @@ if menu == "Settings":
         st.info("Ye slabs **Reports → Salary Increment** me use honge (month range avg score ke basis par).")
 
         if st.button("💾 Save Salary Slabs", use_container_width=True, type="primary"):
-            set_salary_slab("Excellent", n_ex)
-            set_salary_slab("Good", n_gd)
-            set_salary_slab("Average", n_av)
-            set_salary_slab("Needs Improvement", n_ni)
-            log_action(username, "UPDATE_SALARY_SLABS", f"Ex:{n_ex}, Gd:{n_gd}, Av:{n_av}, NI:{n_ni}")
-            st.success("✅ Salary slabs saved!")
-            st.rerun()
+            uow = UnitOfWork()
+            set_salary_slab("Excellent", n_ex, uow)
+            set_salary_slab("Good", n_gd, uow)
+            set_salary_slab("Average", n_av, uow)
+            set_salary_slab("Needs Improvement", n_ni, uow)
+            if uow.commit():
+                invalidate_scoring_policy()
+                log_action(username, "UPDATE_SALARY_SLABS", f"Ex:{n_ex}, Gd:{n_gd}, Av:{n_av}, NI:{n_ni}")
+                st.success("✅ Salary slabs saved!")
+                st.rerun()
 
     with tab5:
         st.markdown("### System")
@@ -1728,19 +3742,22 @@ if menu == "Settings":
             allow_edit = st.checkbox("✏️ Edit/Delete", value=cur_edit)
 
         if st.button("💾 Save System", use_container_width=True, type="primary"):
-            set_setting("allow_import", "1" if allow_import else "0")
-            set_setting("allow_edit_delete", "1" if allow_edit else "0")
-            log_action(username, "UPDATE_SYSTEM", f"Import:{allow_import}, Edit:{allow_edit}")
-            st.success("✅ Saved!")
-            st.rerun()
+            uow = UnitOfWork()
+            set_setting("allow_import", "1" if allow_import else "0", uow)
+            set_setting("allow_edit_delete", "1" if allow_edit else "0", uow)
+            if uow.commit():
+                log_action(username, "UPDATE_SYSTEM", f"Import:{allow_import}, Edit:{allow_edit}")
+                st.success("✅ Saved!")
+                st.rerun()
 
         st.markdown("---")
         st.markdown("### 📊 System Info")
 
-        total_users = len(execute_query("SELECT id FROM users", fetch=True) or [])
-        total_emps = len(execute_query("SELECT id FROM employees", fetch=True) or [])
-        total_depts = len(execute_query("SELECT id FROM departments", fetch=True) or [])
-        total_entries = len(execute_query("SELECT id FROM kpi_entries", fetch=True) or [])
+        counts = get_entity_counts()
+        total_users = counts.get("users", 0)
+        total_emps = counts.get("employees", 0)
+        total_depts = counts.get("departments", 0)
+        total_entries = counts.get("kpi_entries", 0)
 
         col_i1, col_i2, col_i3, col_i4 = st.columns(4)
         col_i1.metric("👥 Users", total_users)
@@ -1748,6 +3765,86 @@ if menu == "Settings":
         col_i3.metric("🏢 Departments", total_depts)
         col_i4.metric("📝 Entries", total_entries)
 
+        st.markdown("---")
+        st.markdown("### 🧮 Monthly Summary")
+        st.caption("Reports and trends read kpi_monthly_summary, kept current by database triggers.")
+
+        if st.button("🔄 Rebuild Monthly Summary", use_container_width=True):
+            if rebuild_monthly_summary():
+                bump_generation("kpi_entries")
+                log_action(username, "REBUILD_SUMMARY", "kpi_monthly_summary rebuilt from kpi_entries")
+                st.success("✅ Summary rebuilt!")
+
+        st.markdown("---")
+        st.markdown("### 🔌 Connection Pool")
+
+        pool_stats = get_pool_stats()
+        col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+        col_p1.metric("🔗 Checked Out", pool_stats["checked_out"])
+        col_p2.metric("💤 Idle", pool_stats["idle"])
+        col_p3.metric("➕ Overflow", pool_stats["overflow"])
+        col_p4.metric("📦 Size / Max", f"{pool_stats['size']} / {pool_stats['max']}")
+        if pool_stats["pgbouncer"]:
+            st.caption("PgBouncer mode: prepared statements disabled")
+        if pool_stats["replica"]:
+            st.caption("Read replica configured: read-only queries use it; cached loads only once it has "
+                       "replayed the latest write")
+        st.caption(f"Circuit breaker: {pool_stats['breaker']} • tripped {pool_stats['breaker_trips']}× since start")
+
+        st.markdown("---")
+        st.markdown("### 🗃️ Result Cache")
+
+        cache_stats = get_result_cache().stats()
+        col_c1, col_c2, col_c3, col_c4 = st.columns(4)
+        col_c1.metric("📚 Results Cached", cache_stats["entries"])
+        col_c2.metric("💾 Memory", f"{cache_stats['bytes'] / 1048576:.1f} / {cache_stats['max_bytes'] / 1048576:.0f} MB")
+        col_c3.metric("🎯 Hit Rate", f"{cache_stats['hit_rate']:.0%}")
+        col_c4.metric("♻️ Evictions", cache_stats["evictions"])
+
+        st.markdown("---")
+        st.markdown("### 📝 Audit Writer")
+
+        audit_stats = get_audit_sink().metrics()
+        col_a1, col_a2, col_a3, col_a4 = st.columns(4)
+        col_a1.metric("📥 Queued", f"{audit_stats['depth']} / {audit_stats['capacity']}")
+        col_a2.metric("✅ Written", audit_stats["written"])
+        col_a3.metric("🚫 Dropped", audit_stats["dropped"])
+        col_a4.metric("⚠️ Failed", audit_stats["failed"])
+        if audit_stats["last_error"]:
+            st.caption(f"Last write error: {audit_stats['last_error']}")
+
+        st.markdown("---")
+        st.markdown("### 🗄️ Audit Retention")
+        st.caption("audit_log is partitioned by month. Partitions older than the retention window are "
+                   "detached, archived as gzip CSV and dropped. 0 keeps everything.")
+
+        cur_retention = int(get_setting("audit_retention_months", "0") or 0)
+        col_r1, col_r2 = st.columns(2)
+
+        with col_r1:
+            retention = st.number_input("Keep months", min_value=0, max_value=120, value=cur_retention, step=1)
+
+        with col_r2:
+            st.write("")
+            if st.button("💾 Save & Apply Retention", use_container_width=True):
+                set_setting("audit_retention_months", str(int(retention)))
+                try:
+                    archived = archive_audit_partitions(int(retention))
+                except Exception as e:
+                    st.error(f"❌ Archive failed: {e}")
+                else:
+                    log_action(username, "UPDATE_AUDIT_RETENTION",
+                               f"{int(retention)} months, archived {len(archived)} partitions")
+                    st.success(f"✅ Saved! Archived {len(archived)} partition(s)")
+
+        partitions = list_audit_partitions()
+        if partitions:
+            st.dataframe(pd.DataFrame([(n, m.strftime("%Y-%m"), est) for n, m, est in partitions],
+                                      columns=["Partition", "Month", "Rows (est.)"]),
+                         use_container_width=True, hide_index=True)
+        if audit_maintenance_error:
+            st.caption(f"Partition maintenance failed (retried on the next rerun): {audit_maintenance_error}")
+
     st.markdown("</div>", unsafe_allow_html=True)
 
 # ============================================================